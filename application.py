@@ -1,27 +1,217 @@
+import hmac
 import os
+import random
+import threading
 from pathlib import PurePath
 
-from flask import Flask, render_template, redirect, url_for, flash, request
+import psycopg2
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, g, current_app, session
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, SubmitField, SelectField, FloatField, PasswordField, ValidationError, TextAreaField, IntegerField
-from wtforms.validators import Email, Length, DataRequired, NumberRange, InputRequired, EqualTo, Optional
+from wtforms.validators import Email, Length, DataRequired, NumberRange, InputRequired, Optional
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, AnonymousUserMixin
 
 import db
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'Bagel Boiz Bun Roasting Bonanza'
+import autocomplete
+import feed_snapshot
+import notifications
+import profiler
+import ratelimit
+
+# Listing names for autocomplete, built from the produce vocabulary and active listings
+listing_names = autocomplete.PrefixIndex()
+
+# Endpoints that answer without a database connection skip the admission gate
+DB_FREE_ENDPOINTS = {'static', 'autocomplete_listing_name', 'metrics'}
+
+# (rule, view function, options) for every page; added to the app by create_app().
+# Not a Blueprint: that would rename every endpoint to 'blueprint.view', and the endpoint
+# names are used by url_for() in the templates, the admission limits, DB_FREE_ENDPOINTS,
+# PROFILE_ENDPOINTS and asgi.py's ASYNC_ENDPOINTS.
+routes = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        routes.append((rule, view, options))
+        return view
+    return decorator
+
+
+def load_config():
+    """Settings from the environment, falling back to db_config.py for the database"""
+    config = {
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'Bagel Boiz Bun Roasting Bonanza'),
+        'DATA_SOURCE_NAME': os.environ.get('DATA_SOURCE_NAME'),
+        # Also the size of each worker's connection pool
+        'MAX_CONCURRENT_REQUESTS': int(os.environ.get('MAX_CONCURRENT_REQUESTS', 16)),
+        'RATELIMIT_REDIS_URL': os.environ.get('RATELIMIT_REDIS_URL'),
+        # Under asgi.py, each worker also keeps an asyncpg pool of this many connections for the async views
+        'ASYNC_POOL_SIZE': int(os.environ.get('ASYNC_POOL_SIZE', 4)),
+        # Set to 0 when notifications are delivered by a separate `python notifications.py` process
+        'NOTIFICATION_WORKER': os.environ.get('NOTIFICATION_WORKER', '1') == '1',
+        # Serve /feed from the feed_snapshot view, falling back to the live query when it is older than
+        # FEED_SNAPSHOT_MAX_STALENESS seconds. The view is refreshed every FEED_SNAPSHOT_INTERVAL seconds.
+        'FEED_SNAPSHOT': os.environ.get('FEED_SNAPSHOT', '0') == '1',
+        'FEED_SNAPSHOT_MAX_STALENESS': float(os.environ.get('FEED_SNAPSHOT_MAX_STALENESS', 30)),
+        'FEED_SNAPSHOT_INTERVAL': float(os.environ.get('FEED_SNAPSHOT_INTERVAL', 10)),
+        # How often each worker rebuilds the autocomplete index from the active listing counts
+        'AUTOCOMPLETE_RELOAD_INTERVAL': float(os.environ.get('AUTOCOMPLETE_RELOAD_INTERVAL', 60)),
+        # A request is profiled when its X-Profile header matches PROFILE_TOKEN, or at random for
+        # PROFILE_SAMPLE_RATE of the requests to PROFILE_ENDPOINTS (comma separated; empty for all).
+        # Profiles go to PROFILE_DIR, which keeps the newest PROFILE_MAX_FILES.
+        'PROFILE_TOKEN': os.environ.get('PROFILE_TOKEN', ''),
+        'PROFILE_SAMPLE_RATE': float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+        'PROFILE_ENDPOINTS': [endpoint for endpoint in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if endpoint],
+        'PROFILE_DIR': os.environ.get('PROFILE_DIR', 'profiles'),
+        'PROFILE_MAX_FILES': int(os.environ.get('PROFILE_MAX_FILES', 200)),
+        'PROFILE_INTERVAL': float(os.environ.get('PROFILE_INTERVAL', 0.005)),
+    }
+
+    if config['DATA_SOURCE_NAME'] is None:
+        try:
+            import db_config
+            config['DATA_SOURCE_NAME'] = db_config.data_source_name
+        except ImportError:
+            pass
+    return config
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(load_config())
+    if config is not None:
+        app.config.update(config)
+
+    login_mgr.init_app(app)
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view.__name__, view, **options)
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+
+    if app.config['RATELIMIT_REDIS_URL']:
+        admission = ratelimit.Admission(app.config['MAX_CONCURRENT_REQUESTS'],
+                                        ratelimit.RedisBackend(app.config['RATELIMIT_REDIS_URL']))
+    else:
+        admission = ratelimit.Admission(app.config['MAX_CONCURRENT_REQUESTS'])
+    admission.limit('login', rate=5 / 60, burst=5, key='ip', methods=('POST',))
+    admission.limit('buy_listing', rate=1, burst=10)
+    admission.limit('checkout', rate=1, burst=10)
+    admission.limit('create_listing', rate=10 / 60, burst=5, methods=('POST',), concurrency=4)
+    app.extensions['admission'] = admission
+
+    return app
+
+
+def preload(app):
+    """Work worth sharing between forked workers: call in the server's master process"""
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+
+
+def load_listing_names(app):
+    """Rebuild listing_names from the produce vocabulary and the current active listing counts"""
+    vocabulary = autocomplete.read_vocabulary(os.path.join(app.root_path, 'scripts', 'veggieNames.txt'))
+    # A connection of its own: the pool is sized for the requests admitted and raises when empty
+    with app.app_context():
+        g.connection = psycopg2.connect(app.config['DATA_SOURCE_NAME'])
+        try:
+            g.cursor = g.connection.cursor()
+            listing_names.load(vocabulary, db.active_listing_name_counts())
+        finally:
+            g.connection.close()
+
+
+def reload_listing_names(app, stop):
+    # Between reloads create_listing only adds to the counts. A reload drops what was sold out,
+    # expired or renamed since, and picks up the listings other workers created.
+    while not stop.wait(app.config['AUTOCOMPLETE_RELOAD_INTERVAL']):
+        try:
+            load_listing_names(app)
+        except Exception:
+            app.logger.exception('Reloading the autocomplete index failed')
+
+
+def init_worker(app):
+    """Per-process resources: call in each worker after it has been forked"""
+    db.open_pool(app.config['DATA_SOURCE_NAME'], app.config['MAX_CONCURRENT_REQUESTS'])
+    db.start_invalidation_listener(app.config['DATA_SOURCE_NAME'])
+    load_listing_names(app)
+    threading.Thread(target=reload_listing_names, args=(app, threading.Event()), name='listing-names',
+                     daemon=True).start()
+    if app.config['NOTIFICATION_WORKER']:
+        notifications.start_worker(app.config['DATA_SOURCE_NAME'])
+    if app.config['FEED_SNAPSHOT']:
+        feed_snapshot.start_refresher(app.config['DATA_SOURCE_NAME'], app.config['FEED_SNAPSHOT_INTERVAL'])
+
+
+def __getattr__(name):
+    # Build the default app the first time `application.app` is used, not at import
+    if name == 'app':
+        global app
+        app = create_app()
+        app.logger.warning('application.app is built without init_worker(): no notification worker, '
+                           'profile cache listener or autocomplete reloads run in this process. Serve with '
+                           "gunicorn -c gunicorn.conf.py 'application:create_app()' or hypercorn asgi:app")
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def should_profile():
+    token = current_app.config['PROFILE_TOKEN']
+    # Compared as bytes: compare_digest refuses str with non-ASCII characters. WSGI header values
+    # are latin-1 decoded, so this gets back the bytes that were sent.
+    if token and hmac.compare_digest(request.headers.get('X-Profile', '').encode('latin-1'), token.encode()):
+        return True
+    endpoints = current_app.config['PROFILE_ENDPOINTS']
+    if endpoints and request.endpoint not in endpoints:
+        return False
+    return random.random() < current_app.config['PROFILE_SAMPLE_RATE']
+
+
+def rejection_response(status, retry_after):
+    """The response for a request turned away by admission control"""
+    message = 'Too many requests' if status == 429 else 'Server busy, please try again'
+    return message, status, {'Retry-After': str(retry_after)}
 
 
-@app.before_request
 def before_request():
+    if should_profile():
+        g.profile = profiler.Profile(threading.get_ident(), current_app.config['PROFILE_INTERVAL'])
+        g.profile.start()
+
+    if request.endpoint in DB_FREE_ENDPOINTS and (request.endpoint != 'autocomplete_listing_name' or listing_names.loaded):
+        return
+
+    account = current_user.email if current_user.is_authenticated else None
+    rejected = current_app.extensions['admission'].admit(request.endpoint, request.method, account, request.remote_addr)
+    if rejected is not None:
+        return rejection_response(*rejected)
+    g.admitted = True
+
     db.open_db_connection()
+    if 'profile' in g:
+        g.cursor = profiler.CountingCursor(g.cursor, g.profile)
+    # init_worker builds the index at startup; this covers apps run without it, e.g. in the tests
+    if not listing_names.loaded:
+        vocabulary = autocomplete.read_vocabulary(os.path.join(current_app.root_path, 'scripts', 'veggieNames.txt'))
+        listing_names.load(vocabulary, db.active_listing_name_counts())
 
 
-@app.teardown_request
 def teardown_request(exception):
     db.close_db_connection()
+    if g.pop('admitted', False):
+        current_app.extensions['admission'].release(request.endpoint, request.method)
+
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+        tags = {'endpoint': request.endpoint, 'rule': request.url_rule.rule if request.url_rule else None,
+                'method': request.method, 'path': request.path, 'error': repr(exception) if exception else None}
+        profile.write(os.path.join(current_app.root_path, current_app.config['PROFILE_DIR']),
+                      request.endpoint or 'not_found', tags,
+                      current_app.config['PROFILE_MAX_FILES'])
 
 
 class Anonymous(AnonymousUserMixin):
@@ -30,14 +220,14 @@ class Anonymous(AnonymousUserMixin):
 
 
 # Init Login Manager
-login_mgr = LoginManager(app)
+login_mgr = LoginManager()
 login_mgr.anonymous_user = Anonymous
 
 
 def authenticate(email, password):
-    for account in db.all_accounts():
-        if email == account[1] and password == account[4]:
-            return email
+    row = db.find_password(email)
+    if row is not None and password == row['password']:
+        return email
     return None
 
 
@@ -72,7 +262,7 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Log In')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
@@ -83,10 +273,10 @@ def login():
             return redirect(url_for('index'))
         else:
             flash('Invalid email address or password')
-    return render_template('login.html', form=form, hacker_news=db.all_accounts())
+    return render_template('login.html', form=form)
 
 
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     logout_user()
@@ -95,46 +285,44 @@ def logout():
 
 
 # Routes site to Main index page
-@app.route('/')
+@route('/')
 def index():
     return redirect(url_for('render_feed'))
 
 
 # Routes to a testing page
-@app.route('/testing')
+@route('/testing')
 def testing():
     return render_template('testing.html')
 
 
-@app.route('/all_accounts')
+@route('/all_accounts')
 def all_accounts():
     # print(db.all_accounts())
     return render_template('all-accounts.html', accounts=db.all_accounts())
 
 
-@app.route('/about')
+@route('/about')
 def about():
     # print(db.all_accounts())
     return render_template('about.html', accounts=db.all_accounts())
 
 
-@app.route('/find_account/<email>')
+@route('/find_account/<email>')
 def find_account(email):
-    account = db.find_account(email)
+    account = db.cached_find_account(email)
 
     if account is None:
         flash('404 Account not found')
         return redirect(url_for('render_feed'))
     else:
-        listings = db.listings_by_account(email)
+        listings = db.cached_listings_by_account(email)
         return render_template('account.html', account=account, listings=listings)
 
 
 class AccountForm(FlaskForm):
-    if current_user is not None:
-        passwordValidator = [Optional()]
-    else:
-        passwordValidator = [Length(min=6), EqualTo('confirm', message='Passwords must match')]
+    # Optional so an update can leave the password blank to keep the current one
+    passwordValidator = [Optional()]
 
     email = StringField("Email", validators=[Email()])
     first_name = StringField('First Name', validators=[Length(min=1, max=40), InputRequired()])
@@ -158,13 +346,18 @@ class ListingForm(FlaskForm):
     submit = SubmitField('Save Listing')
 
 
+# Only the CSRF token, for buttons that POST to change state
+class ButtonForm(FlaskForm):
+    pass
+
+
 class BuyForm(FlaskForm):
     id = IntegerField('id', validators=[NumberRange(min=0, max=99999)])
     amount = FloatField('Amount', validators=[NumberRange(min=0, max=2000)])
     buy = SubmitField('Buy!')
 
 
-@app.route('/all_accounts/create', methods=['GET', 'POST'])
+@route('/all_accounts/create', methods=['GET', 'POST'])
 def create_account():
     account_form = AccountForm()
 
@@ -189,7 +382,7 @@ def create_account():
     return render_template('account-form.html', form=account_form, mode='create')
 
 
-@app.route('/all_accounts/update/<email>', methods=['GET', 'POST'])
+@route('/all_accounts/update/<email>', methods=['GET', 'POST'])
 @login_required
 def update_account(email):
     row = db.find_account(email)
@@ -218,7 +411,7 @@ def update_account(email):
     return render_template('account-form.html', form=account_form, mode='update')
 
 
-@app.route('/all_listings/create', methods=['GET', 'POST'])
+@route('/all_listings/create', methods=['GET', 'POST'])
 @login_required
 def create_listing():
     listing_form = ListingForm()
@@ -228,6 +421,7 @@ def create_listing():
 
     if listing_form.validate_on_submit():
         if current_user is not None:
+            listing_form.name.data = listing_names.canonical(listing_form.name.data)
             listing_id = db.create_listing(listing_form.name.data,
                                            listing_form.quantity.data,
                                            listing_form.description.data,
@@ -236,6 +430,8 @@ def create_listing():
                                            listing_form.unit.data)
 
             if listing_id is not 0:
+                listing_names.add(listing_form.name.data)
+
                 if listing_form.photo.data is not None:
                     uploaded_photo = listing_form.photo.data
 
@@ -249,7 +445,7 @@ def create_listing():
                     file_path = 'photos/' + file_name
                     print("FILE PATH", file_path)
 
-                    save_path = os.path.join(app.static_folder, file_path)
+                    save_path = os.path.join(current_app.static_folder, file_path)
                     print("SAVE PATH", save_path)
                     uploaded_photo.save(save_path)
                     db.add_listing_photo_path(listing_id, '/static/' + file_path)
@@ -264,7 +460,7 @@ def create_listing():
     return render_template('listing_form.html', form=listing_form, mode='create')
 
 
-@app.route('/all_listings/update/<id>', methods=['GET', 'POST'])
+@route('/all_listings/update/<id>', methods=['GET', 'POST'])
 @login_required
 def update_listing(id):
     row = db.find_listing(id)
@@ -280,6 +476,7 @@ def update_listing(id):
                                unit=row['unit'])
 
     if listing_form.validate_on_submit():
+        listing_form.name.data = listing_names.canonical(listing_form.name.data)
         rowcount = db.update_listing(id,
                                      listing_form.name.data,
                                      listing_form.quantity.data,
@@ -299,7 +496,7 @@ def update_listing(id):
             file_path = 'photos/' + file_name
             print("FILE PATH", file_path)
 
-            save_path = os.path.join(app.static_folder, file_path)
+            save_path = os.path.join(current_app.static_folder, file_path)
             print("SAVE PATH", save_path)
             uploaded_photo.save(save_path)
             db.add_listing_photo_path(id, '/static/' + file_path)
@@ -312,7 +509,7 @@ def update_listing(id):
     return render_template('listing_form.html', form=listing_form)
 
 
-@app.route('/feed/buy/<listing_id>/<amount>', methods=['POST'])
+@route('/feed/buy/<listing_id>/<amount>', methods=['POST'])
 @login_required
 def buy_listing(listing_id, amount):
     if amount <= db.find_listing(listing_id)['quantity']:
@@ -324,7 +521,7 @@ def buy_listing(listing_id, amount):
 
 
 # Render 'feed' as homepage
-@app.route('/feed')
+@route('/feed')
 def render_feed():
     buy_form = BuyForm()
     if buy_form.validate_on_submit():
@@ -333,36 +530,136 @@ def render_feed():
     db.check_expire_all()
     num_items = 100
     if current_user:
-        return render_template('feed.html', feedItems=db.fetch_feed(num_items, current_user.email), form=buy_form)
+        feed_items = None
+        if current_app.config['FEED_SNAPSHOT']:
+            feed_items = db.fetch_feed_snapshot(num_items, current_user.email,
+                                                current_app.config['FEED_SNAPSHOT_MAX_STALENESS'])
+        if feed_items is None:
+            feed_items = db.fetch_feed(num_items, current_user.email)
+        return render_template('feed.html', feedItems=feed_items, form=buy_form)
     else:
         return render_template('feed.html', feedItems=db.fetch_feed(num_items), form=buy_form)
 
 
+# The cart is kept in the session as {listing id (a string, as session keys must be): amount}
+def session_cart():
+    return {int(listing_id): amount for listing_id, amount in session.get('cart', {}).items()}
+
+
+@route('/cart')
+@login_required
+def render_cart():
+    cart = session_cart()
+    items = [(listing, cart[listing['id']]) for listing in db.find_listings(cart)]
+    total = sum(listing['price'] * amount for listing, amount in items)
+    return render_template('cart.html', items=items, total=total, form=ButtonForm())
+
+
+@route('/cart/add', methods=['POST'])
+@login_required
+def add_to_cart():
+    buy_form = BuyForm()
+    if buy_form.validate_on_submit() and buy_form.amount.data > 0:
+        cart = session.get('cart', {})
+        listing_id = str(buy_form.id.data)
+        cart[listing_id] = cart.get(listing_id, 0) + buy_form.amount.data
+        session['cart'] = cart
+        flash('Added to your cart')
+    else:
+        flash('Invalid amount')
+    return redirect(url_for('render_feed'))
+
+
+@route('/cart/remove/<int:listing_id>', methods=['POST'])
+@login_required
+def remove_from_cart(listing_id):
+    if not ButtonForm().validate_on_submit():
+        flash('Your session expired, please try again')
+        return redirect(url_for('render_cart'))
+    cart = session.get('cart', {})
+    cart.pop(str(listing_id), None)
+    session['cart'] = cart
+    return redirect(url_for('render_cart'))
+
+
+@route('/cart/checkout', methods=['POST'])
+@login_required
+def checkout():
+    if not ButtonForm().validate_on_submit():
+        flash('Your session expired, please try again')
+        return redirect(url_for('render_cart'))
+    try:
+        transaction_ids = db.checkout(current_user.email, session_cart())
+    except db.InsufficientStock as e:
+        names = ', '.join(listing['name'] for listing in db.find_listings(e.listing_ids))
+        flash('Not enough left of: {}. Nothing was bought.'.format(names or 'removed listings'))
+        return redirect(url_for('render_cart'))
+
+    session.pop('cart', None)
+    flash('You bought {} items'.format(len(transaction_ids)))
+    return redirect(url_for('render_feed'))
+
+
+@route('/autocomplete')
+def autocomplete_listing_name():
+    return jsonify(listing_names.complete(request.args.get('q', ''), 10))
+
+
+@route('/notifications')
+@login_required
+def render_notifications():
+    return render_template('notifications.html', notifications=db.list_notifications(current_user.email, 50),
+                           form=ButtonForm())
+
+
+@route('/notifications/unread_count')
+@login_required
+def unread_notification_count():
+    return jsonify({'unread': db.unread_notification_count(current_user.email)})
+
+
+@route('/notifications/read', methods=['POST'])
+@login_required
+def mark_notifications_read():
+    if not ButtonForm().validate_on_submit():
+        flash('Your session expired, please try again')
+        return redirect(url_for('render_notifications'))
+    db.mark_notifications_read(current_user.email)
+    return redirect(url_for('render_notifications'))
+
+
+@route('/metrics')
+def metrics():
+    return current_app.extensions['admission'].metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 # View Message
-@app.route('/view_message')
+@route('/view_message')
 def render_message():
 
     messages = db.fetch_messages(me, you)
     return render_template('view_message.html', messages=messages)
 
 
-@app.route('/mark_favorite', methods=['POST'])
+@route('/mark_favorite', methods=['POST'])
 def mark_favorite():
     db.mark_favorite(current_user.email, request.form["favorite_email"])
     return "OK"
 
 
-@app.route('/favorites/<email>')
+@route('/favorites/<email>')
 @login_required
 def favorites(email):
-    account = db.find_account(email)
+    account = db.cached_find_account(email)
 
     if account is None:
         flash('404 Account not found')
         return redirect(url_for('render_feed'))
-    return render_template('favorites.html', account=account, favorites=db.list_favorites(email))
+    return render_template('favorites.html', account=account, favorites=db.cached_list_favorites(email))
 
 
 # Make this the last line in the file!
 if __name__ == '__main__':
+    app = create_app()
+    init_worker(app)
     app.run(debug=True)
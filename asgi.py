@@ -0,0 +1,180 @@
+"""ASGI entry point: serve with e.g. `hypercorn asgi:app`
+
+The read-heavy pages (feed, profiles, favorites, messages) are served by async views that
+use db_async and run independent queries concurrently. Every other URL is passed through
+to the regular Flask application in application.py, so both modes share the same routes,
+templates, session cookie and login.
+"""
+import asyncio
+import hashlib
+import os
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from itsdangerous import URLSafeTimedSerializer
+from quart import Quart, render_template, redirect, url_for, flash, request, session, g
+from werkzeug.exceptions import HTTPException
+from wtforms import Form, HiddenField
+
+import application
+import db_async
+
+flask_app = application.create_app()
+
+quart_app = Quart(__name__)
+quart_app.config['SECRET_KEY'] = flask_app.config['SECRET_KEY']
+
+wsgi_app = AsyncioWSGIMiddleware(flask_app)
+
+ASYNC_ENDPOINTS = {'render_feed', 'find_account', 'favorites', 'render_message'}
+
+
+class Guest(object):
+    email = 'Guest'
+    is_authenticated = False
+    is_anonymous = True
+
+
+def get_current_user():
+    # flask_login keeps the logged in account's email under '_user_id' in the shared session cookie
+    email = session.get('_user_id')
+    if email is None:
+        return Guest()
+    return application.Account(email)
+
+
+@quart_app.context_processor
+def inject_current_user():
+    return {'current_user': get_current_user()}
+
+
+@quart_app.before_serving
+async def before_serving():
+    # The same per-process setup gunicorn.conf.py runs: pool, notification worker, caches
+    application.init_worker(flask_app)
+    await db_async.open_pool(flask_app.config['DATA_SOURCE_NAME'], min_size=1,
+                             max_size=flask_app.config['ASYNC_POOL_SIZE'])
+
+
+@quart_app.after_serving
+async def after_serving():
+    await db_async.close_pool()
+
+
+@quart_app.before_request
+async def before_request():
+    user = get_current_user()
+    rejected = flask_app.extensions['admission'].admit(request.endpoint, request.method,
+                                                       user.email if user.is_authenticated else None, request.remote_addr)
+    if rejected is not None:
+        return application.rejection_response(*rejected)
+    g.admitted = True
+
+
+@quart_app.teardown_request
+async def teardown_request(exception):
+    if g.pop('admitted', False):
+        flask_app.extensions['admission'].release(request.endpoint, request.method)
+
+
+def generate_csrf():
+    """A CSRF token the Flask routes accept, for forms rendered by the async views.
+
+    Same scheme as flask_wtf.csrf.generate_csrf: a random value kept in the shared session
+    cookie, signed with the Flask app's secret key.
+    """
+    field_name = flask_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    if field_name not in session:
+        session[field_name] = hashlib.sha1(os.urandom(64)).hexdigest()
+    secret_key = flask_app.config.get('WTF_CSRF_SECRET_KEY') or flask_app.config['SECRET_KEY']
+    return URLSafeTimedSerializer(secret_key, salt='wtf-csrf-token').dumps(session[field_name])
+
+
+class BuyForm(Form):
+    csrf_token = HiddenField()
+    id = application.BuyForm.id
+    amount = application.BuyForm.amount
+    buy = application.BuyForm.buy
+
+
+@quart_app.route('/feed')
+async def render_feed():
+    await db_async.check_expire_all()
+    email = get_current_user().email
+    feed_items = None
+    if flask_app.config['FEED_SNAPSHOT']:
+        feed_items = await db_async.fetch_feed_snapshot(100, email, flask_app.config['FEED_SNAPSHOT_MAX_STALENESS'])
+    if feed_items is None:
+        feed_items = await db_async.fetch_feed(100, email)
+    # The buy form posts to the Flask /cart/add route, which checks the CSRF token
+    buy_form = BuyForm()
+    buy_form.csrf_token.data = generate_csrf()
+    return await render_template('feed.html', feedItems=feed_items, form=buy_form)
+
+
+@quart_app.route('/find_account/<email>')
+async def find_account(email):
+    async def active_listings():
+        await db_async.check_expire_all()
+        return await db_async.listings_by_account(email)
+
+    account, listings = await asyncio.gather(db_async.find_account(email), active_listings())
+
+    if account is None:
+        await flash('404 Account not found')
+        return redirect(url_for('render_feed'))
+    return await render_template('account.html', account=account, listings=listings)
+
+
+@quart_app.route('/favorites/<email>')
+async def favorites(email):
+    if not get_current_user().is_authenticated:
+        await flash("You must be logged in to proceed")
+        return redirect(url_for('login'))
+
+    account, favorite_rows = await asyncio.gather(db_async.find_account(email), db_async.list_favorites(email))
+
+    if account is None:
+        await flash('404 Account not found')
+        return redirect(url_for('render_feed'))
+    return await render_template('favorites.html', account=account, favorites=favorite_rows)
+
+
+@quart_app.route('/view_message')
+async def render_message():
+    user = get_current_user()
+    if not user.is_authenticated:
+        await flash("You must be logged in to proceed")
+        return redirect(url_for('login'))
+
+    messages = []
+    other_email = request.args.get('with')
+    if other_email is not None:
+        me, you = await asyncio.gather(db_async.get_id_from_email(user.email),
+                                       db_async.get_id_from_email(other_email))
+        messages = await db_async.fetch_messages(me, you)
+    return await render_template('view_message.html', messages=messages)
+
+
+def _served_by_wsgi(**kwargs):
+    raise RuntimeError('Requests for this URL are dispatched to the Flask application')
+
+
+# Register the Flask-only routes too, so url_for() in shared templates can build their URLs
+for rule in flask_app.url_map.iter_rules():
+    if rule.endpoint not in quart_app.view_functions:
+        quart_app.add_url_rule(rule.rule, rule.endpoint, _served_by_wsgi, methods=rule.methods)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        adapter = quart_app.url_map.bind('localhost')
+        try:
+            endpoint, _ = adapter.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            endpoint = None
+
+        if endpoint not in ASYNC_ENDPOINTS:
+            await wsgi_app(scope, receive, send)
+            return
+
+    await quart_app(scope, receive, send)
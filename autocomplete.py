@@ -0,0 +1,123 @@
+import re
+import threading
+from bisect import bisect_left, insort
+
+
+def clean_name(name):
+    """Lowercase a name, drop punctuation and collapse its whitespace"""
+    key = re.sub(r'[^a-z0-9\- ]', '', name.lower())
+    return ' '.join(key.split())
+
+
+def normalize_name(name):
+    """Reduce a listing name to the key used for grouping, e.g. 'Tomatoes ' and 'tomato' both become 'tomato'"""
+    words = clean_name(name).split(' ')
+    words[-1] = singularize(words[-1])
+    return ' '.join(words)
+
+
+def singularize(word):
+    if len(word) <= 3 or word.endswith('ss') or word.endswith('us'):
+        return word
+    if word.endswith('ies'):
+        return word[:-3] + 'y'
+    if word.endswith('oes') or word.endswith('ches') or word.endswith('shes') or word.endswith('xes'):
+        return word[:-2]
+    if word.endswith('s'):
+        return word[:-1]
+    return word
+
+
+def plurals(key):
+    """The plural spellings of a key, the names normalize_name reduces back to it"""
+    forms = [key + 's', key + 'es']
+    if key.endswith('y'):
+        forms.append(key[:-1] + 'ies')
+    return [form for form in forms if normalize_name(form) == key]
+
+
+class PrefixIndex(object):
+    """In-memory prefix index of listing names, kept as a sorted list of normalized keys.
+
+    Each key maps to the display name first registered for it and the number of active
+    listings using it. Lookups only touch memory, so they never go to the database.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._keys = []
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load(self, vocabulary, name_counts):
+        """(Re)build the index from vocabulary words and (name, active count) rows"""
+        keys = []
+        entries = {}
+        for word in vocabulary:
+            self._add(keys, entries, word.strip().title(), 0)
+        for name, count in name_counts:
+            self._add(keys, entries, name, count)
+
+        with self._lock:
+            self._keys = keys
+            self._entries = entries
+            self.loaded = True
+
+    def add(self, name, count=1):
+        """Register a newly created listing name and return its canonical display name"""
+        with self._lock:
+            return self._add(self._keys, self._entries, name, count)
+
+    def canonical(self, name):
+        """Return the display name already used for this name's key, or the cleaned up name itself"""
+        key = normalize_name(name)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return ' '.join(name.split())
+        return entry[0]
+
+    def complete(self, prefix, limit=10):
+        """Return up to `limit` display names starting with `prefix`, most active listings first"""
+        # Not singularized: 'tomatoe' is on its way to 'tomatoes', not a name of its own
+        prefix = clean_name(prefix)
+        if not prefix:
+            return []
+
+        matches = []
+        with self._lock:
+            i = bisect_left(self._keys, prefix)
+            while i < len(self._keys) and self._keys[i].startswith(prefix):
+                display, count = self._entries[self._keys[i]]
+                matches.append((-count, self._keys[i], display))
+                i += 1
+
+            # Keys whose plural starts with the prefix, e.g. 'blueberry' for 'blueberri'. A plural
+            # adds at most three letters to its key's stem, so only a few keys can qualify.
+            for key in {prefix[:-i] + tail for i in range(1, 4) for tail in ('', 'y')}:
+                entry = self._entries.get(key)
+                if (entry is not None and not key.startswith(prefix)
+                        and any(form.startswith(prefix) for form in plurals(key))):
+                    matches.append((-entry[1], key, entry[0]))
+
+        matches.sort()
+        return [display for _, _, display in matches[:limit]]
+
+    @staticmethod
+    def _add(keys, entries, name, count):
+        key = normalize_name(name)
+        if not key:
+            return name
+
+        entry = entries.get(key)
+        if entry is None:
+            entry = [' '.join(name.split()), 0]
+            entries[key] = entry
+            insort(keys, key)
+        entry[1] += count
+        return entry[0]
+
+
+def read_vocabulary(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
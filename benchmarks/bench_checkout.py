@@ -0,0 +1,136 @@
+"""Items bought per second: sequential single buys against concurrent multi-item checkouts.
+
+Every cart draws from the same few listings, so concurrent checkouts contend for the same rows.
+The unordered run locks each cart's rows in cart order, one UPDATE per item, to show the
+deadlocks db.checkout avoids by locking in id order.
+
+Works in a scratch schema (bench_checkout) of the configured database, which is dropped afterwards:
+
+    python benchmarks/bench_checkout.py --threads 8 --carts 200 --cart-size 5
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+from flask import g
+
+import application
+import db
+import migrate
+
+SCHEMA = 'bench_checkout'
+
+SYNTHETIC_DATA = '''
+INSERT INTO account (email, first_name, last_name, password)
+SELECT 'user' || i || '@example.com', 'First', 'Last', 'password' FROM generate_series(1, 100) i;
+
+INSERT INTO listing (name, quantity, description, price, account_email, unit)
+SELECT 'Tomatoes', 1000000, 'Synthetic listing', 5, 'user' || (i %% 100 + 1) || '@example.com', 'lb'
+FROM generate_series(1, %(listings)s) i;
+'''
+
+
+def connect(app):
+    g.connection = psycopg2.connect(app.config['DATA_SOURCE_NAME'])
+    g.cursor = g.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    g.cursor.execute('SET search_path TO {}'.format(SCHEMA))
+    g.connection.commit()
+
+
+def random_carts(count, cart_size, listings):
+    ids = list(range(100, 100 + listings))
+    return [{listing_id: 1 for listing_id in random.sample(ids, cart_size)} for _ in range(count)]
+
+
+def single_buys(buyer_email, cart):
+    for listing_id, amount in cart.items():
+        db.buy_listing(listing_id, amount)
+
+
+def unordered_checkout(buyer_email, cart):
+    for listing_id, amount in cart.items():
+        g.cursor.execute('UPDATE listing SET quantity = quantity - %(amount)s WHERE id = %(id)s',
+                         {'id': listing_id, 'amount': amount})
+        # Hold the lock a moment, as a checkout doing real work between statements would
+        time.sleep(0.001)
+    g.connection.commit()
+
+
+def run(app, buy, carts, threads):
+    """Run buy over carts split across threads; returns (items per second, deadlocks)"""
+    deadlocks = []
+
+    def worker(worker_carts, buyer_email):
+        with app.app_context():
+            connect(app)
+            try:
+                for cart in worker_carts:
+                    try:
+                        buy(buyer_email, cart)
+                    except psycopg2.errors.DeadlockDetected:
+                        g.connection.rollback()
+                        deadlocks.append(cart)
+            finally:
+                g.connection.close()
+
+    workers = [threading.Thread(target=worker, args=(carts[i::threads], 'user{}@example.com'.format(i + 1)))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    items = sum(len(cart) for cart in carts) - sum(len(cart) for cart in deadlocks)
+    return items / elapsed, len(deadlocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--carts', type=int, default=200)
+    parser.add_argument('--cart-size', type=int, default=5)
+    parser.add_argument('--listings', type=int, default=20, help='how many listings the carts share')
+    args = parser.parse_args()
+
+    app = application.create_app()
+    with app.app_context():
+        g.connection = psycopg2.connect(app.config['DATA_SOURCE_NAME'])
+        g.cursor = g.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            g.cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}'.format(SCHEMA))
+            g.connection.commit()
+            with app.open_resource('db/create-db.sql', mode='r') as f:
+                g.cursor.execute(f.read())
+            g.connection.commit()
+            migrate.migrate(g.connection)
+            g.cursor.execute(SYNTHETIC_DATA, {'listings': args.listings})
+            g.connection.commit()
+
+            carts = random_carts(args.carts, args.cart_size, args.listings)
+            for name, buy, threads in [('sequential single buys', single_buys, 1),
+                                       ('sequential checkouts', db.checkout, 1),
+                                       ('concurrent checkouts', db.checkout, args.threads),
+                                       ('concurrent unordered', unordered_checkout, args.threads)]:
+                items_per_second, deadlocks = run(app, buy, carts, threads)
+                print('{:<24} {:2} threads  {:8.0f} items/s  {:4} deadlocks'.format(name, threads, items_per_second,
+                                                                                  deadlocks))
+        finally:
+            g.connection.rollback()
+            g.cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(SCHEMA))
+            g.connection.commit()
+            g.connection.close()
+
+
+if __name__ == '__main__':
+    main()
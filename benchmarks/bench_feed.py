@@ -0,0 +1,91 @@
+"""Feed latency: the live fetch_feed query against the feed_snapshot view, at several table sizes.
+
+Works in a scratch schema (bench_feed) of the configured database, which is dropped afterwards:
+
+    python benchmarks/bench_feed.py --sizes 10000 100000 500000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2.extras
+from flask import g, current_app
+
+import application
+import db
+import migrate
+
+SCHEMA = 'bench_feed'
+
+SYNTHETIC_DATA = '''
+INSERT INTO account (email, first_name, last_name, password)
+SELECT 'user' || i || '@example.com', 'First', 'Last', 'password' FROM generate_series(1, %(accounts)s) i;
+
+INSERT INTO listing (name, quantity, description, price, account_email, unit, time_posted, expired)
+SELECT 'Tomatoes', i %% 10, 'Synthetic listing', 5, 'user' || (i %% %(accounts)s + 1) || '@example.com', 'lb',
+       now() - (i %% 30) * interval '1 day', i %% 30 > 10
+FROM generate_series(1, %(listings)s) i;
+'''
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return statistics.median(times), times[min(len(times) - 1, int(len(times) * 0.99))]
+
+
+def run_size(listings, repeat):
+    with g.connection.cursor() as cursor:
+        with current_app.open_resource('db/create-db.sql', mode='r') as f:
+            cursor.execute(f.read())
+    g.connection.commit()
+    migrate.migrate(g.connection)
+
+    g.cursor.execute(SYNTHETIC_DATA, {'accounts': max(listings // 10, 1), 'listings': listings})
+    g.cursor.execute('ANALYZE account, listing')
+    g.connection.commit()
+
+    start = time.perf_counter()
+    g.cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY feed_snapshot')
+    g.connection.commit()
+    refresh_ms = (time.perf_counter() - start) * 1000
+
+    live = timed(lambda: db.fetch_feed(100, 'user1@example.com'), repeat)
+    snapshot = timed(lambda: db.fetch_feed_snapshot(100, 'user1@example.com', 3600), repeat)
+    print('{:>9} listings   live p50 {:6.2f} ms  p99 {:6.2f} ms   snapshot p50 {:6.2f} ms  p99 {:6.2f} ms   '
+          'refresh {:8.1f} ms'.format(listings, live[0], live[1], snapshot[0], snapshot[1], refresh_ms))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = application.create_app()
+    with app.app_context():
+        g.connection = psycopg2.connect(app.config['DATA_SOURCE_NAME'])
+        g.cursor = g.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            g.cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}'.format(SCHEMA))
+            g.connection.commit()
+            for size in args.sizes:
+                run_size(size, args.repeat)
+        finally:
+            g.connection.rollback()
+            g.cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(SCHEMA))
+            g.connection.commit()
+            g.connection.close()
+
+
+if __name__ == '__main__':
+    main()
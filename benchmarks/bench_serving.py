@@ -0,0 +1,86 @@
+"""Requests per second per core against a running server.
+
+Start the server in one mode, with the same number of workers each time, then point this at it:
+
+    gunicorn -c gunicorn.conf.py -w 4 'application:create_app()'   # sync mode
+    hypercorn -w 4 asgi:app                                        # async mode
+    python benchmarks/bench_serving.py http://localhost:8000 --cores 4
+
+Paths default to the read-heavy pages that have async versions.
+"""
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_PATHS = ['/feed', '/find_account/zelda@ziffle.com', '/find_account/fred@ziffle.com']
+
+
+def worker(base_url, paths, deadline, results, lock):
+    done = 0
+    failed = 0
+    latencies = []
+    i = 0
+    while time.perf_counter() < deadline:
+        url = base_url + paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url) as response:
+                response.read()
+            done += 1
+            latencies.append(time.perf_counter() - start)
+        except (urllib.error.URLError, ConnectionError):
+            failed += 1
+
+    with lock:
+        results['done'] += done
+        results['failed'] += failed
+        results['latencies'].extend(latencies)
+
+
+def run(base_url, paths, concurrency, duration):
+    results = {'done': 0, 'failed': 0, 'latencies': []}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=worker, args=(base_url, paths, deadline, results, lock))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_url')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--cores', type=int, default=1, help='CPU cores given to the server')
+    args = parser.parse_args()
+
+    # Warm up connections, pools and template caches before measuring
+    run(args.base_url, args.paths, args.concurrency, 1)
+    results = run(args.base_url, args.paths, args.concurrency, args.duration)
+
+    rps = results['done'] / args.duration
+    print('requests:        {}'.format(results['done']))
+    print('failed:          {}'.format(results['failed']))
+    print('requests/s:      {:.1f}'.format(rps))
+    print('requests/s/core: {:.1f}'.format(rps / args.cores))
+    print('p50 latency:     {:.1f} ms'.format(percentile(results['latencies'], 0.5) * 1000))
+    print('p99 latency:     {:.1f} ms'.format(percentile(results['latencies'], 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Cold start time: importing the app, building it with create_app() and serving a first request.
+
+Each run happens in a fresh interpreter so nothing is cached between runs:
+
+    python benchmarks/bench_startup.py --runs 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# /metrics needs no database, so this measures the app itself rather than Postgres
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import application
+imported = time.perf_counter()
+app = application.create_app({'TESTING': True})
+created = time.perf_counter()
+response = app.test_client().get('/metrics')
+assert response.status_code == 200
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_request': served - created, 'total': served - start}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    samples = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT)
+        samples.append(json.loads(output.decode().splitlines()[-1]))
+
+    for phase in ('import', 'create_app', 'first_request', 'total'):
+        times = [sample[phase] * 1000 for sample in samples]
+        print('{:<14} median {:7.1f} ms   min {:7.1f} ms   max {:7.1f} ms'.format(
+            phase, statistics.median(times), min(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
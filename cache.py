@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+class Flight(object):
+    """A load in progress that other requests for the same key wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+        self.stale = False
+
+
+class KeyedCache(object):
+    """Values cached per key for `ttl` seconds, loaded at most once at a time per key.
+
+    When several requests miss the same key together, the first runs the loader and the rest
+    wait for its result instead of repeating the query. The cache is per process: writes made
+    by other workers are seen once the owner calls invalidate() (db.py does so on their NOTIFY)
+    or, failing that, once the entry expires.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.failed:
+                return load()
+            return flight.value
+
+        try:
+            flight.value = load()
+        except Exception:
+            flight.failed = True
+            raise
+        else:
+            with self._lock:
+                # An invalidation during the load means the value may predate the write
+                if not flight.stale:
+                    if len(self._entries) >= self.max_entries:
+                        self._prune()
+                    self._entries[key] = (time.monotonic() + self.ttl, flight.value)
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            flight = self._flights.pop(key, None)
+            if flight is not None:
+                flight.stale = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for flight in self._flights.values():
+                flight.stale = True
+            self._flights.clear()
+
+    def _prune(self):
+        now = time.monotonic()
+        for key, (expires, _) in list(self._entries.items()):
+            if expires <= now:
+                del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
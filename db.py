@@ -1,19 +1,51 @@
-from flask import g
+from flask import g, current_app
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import datetime
+import logging
+import os
+import select
+import threading
 
-import db_config
+import cache
+import feed_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Connections are shared by the requests of one process. The pool remembers the pid that
+# opened it so a forked worker never reuses its parent's sockets.
+pool = None
+pool_pid = None
+
+# Account rows, active listings and favorites for the profile pages, keyed by
+# ('account' | 'listings' | 'favorites', email). Writes below invalidate the affected keys in
+# this worker and, through NOTIFY on PROFILE_CACHE_CHANNEL, in every worker running
+# listen_for_invalidations (started by application.init_worker).
+profile_cache = cache.KeyedCache(ttl=30)
+PROFILE_CACHE_CHANNEL = 'profile_cache'
+
+
+def open_pool(data_source_name, max_connections):
+    global pool, pool_pid
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max_connections, data_source_name)
+    pool_pid = os.getpid()
 
 
 def open_db_connection():
-    g.connection = psycopg2.connect(db_config.data_source_name)
+    if pool is None or pool_pid != os.getpid():
+        open_pool(current_app.config['DATA_SOURCE_NAME'], current_app.config['MAX_CONCURRENT_REQUESTS'])
+    g.connection = pool.getconn()
     g.cursor = g.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
 
 def close_db_connection():
-    g.cursor.close()
-    g.connection.close()
+    connection = g.pop('connection', None)
+    if connection is None:
+        return
+    g.pop('cursor').close()
+    connection.rollback()
+    pool.putconn(connection)
 
 
 def all_accounts():
@@ -41,6 +73,11 @@ def find_listing(id):
     return g.cursor.fetchone()
 
 
+def find_listings(ids):
+    g.cursor.execute('SELECT * FROM listing WHERE id = ANY(%(ids)s) ORDER BY id', {'ids': list(ids)})
+    return g.cursor.fetchall()
+
+
 def get_first_photo_path(listing_id):
     g.cursor.execute('SELECT file_path FROM photo WHERE listing_id = %(listing_id)s', {'listing_id': listing_id})
     return g.cursor.fetchone()
@@ -51,6 +88,7 @@ def create_account(email, first_name, last_name, password):
                VALUES (%(email)s, %(first_name)s, %(last_name)s, %(password)s)'''
     g.cursor.execute(query, {'email': email, 'first_name': first_name, 'last_name': last_name, 'password': password})
     g.connection.commit()
+    invalidate_profiles([('account', email)])
     return g.cursor.rowcount
 
 
@@ -65,6 +103,8 @@ def update_account(email, first_name, last_name, bio, password):
                            WHERE email = %(email)s'''
         g.cursor.execute(query, {'email': email, 'first': first_name, 'last': last_name, 'bio': bio})
         g.connection.commit()
+    invalidate_profiles([('account', email)])
+    feed_snapshot.listings_changed()
     return g.cursor.rowcount
 
 
@@ -73,28 +113,149 @@ def create_listing(name, quantity, description, price, account_email, unit):
                VALUES (%(name)s, %(quantity)s, %(description)s, %(price)s, %(account_email)s, %(unit)s) RETURNING id'''
     g.cursor.execute(query, {'name': name, 'quantity': quantity, 'description': description, 'price': price,
                              'account_email': account_email, 'unit': unit})
+    new_listing_id = g.cursor.fetchone()[0]
 
+    # Followers are notified by the notification worker, see notifications.py
+    g.cursor.execute('''INSERT INTO notification_outbox (seller_email, listing_id)
+                        SELECT %(account_email)s, %(listing_id)s
+                        WHERE EXISTS (SELECT 1 FROM account_favorites WHERE favorites_email = %(account_email)s)''',
+                     {'account_email': account_email, 'listing_id': new_listing_id})
     g.connection.commit()
-    new_listing_id = g.cursor.fetchone()[0]
+    listings_changed([(account_email,)])
     return new_listing_id
 
 
 def update_listing(id, name, quantity, description, price, unit):
     query = '''UPDATE listing SET name = %(name)s, quantity = %(quantity)s, description = %(description)s,
-               price = %(price)s, unit = %(unit)s WHERE id = %(id)s'''
+               price = %(price)s, unit = %(unit)s WHERE id = %(id)s RETURNING account_email'''
     g.cursor.execute(query, {'id': id, 'name': name, 'quantity': quantity, 'description': description, 'price': price,
                              'unit': unit})
     g.connection.commit()
+    listings_changed(g.cursor.fetchall())
     return g.cursor.rowcount
 
 
 def buy_listing(id, quantity):
-    query = '''UPDATE listing SET quantity = quantity-%(quantity)s WHERE ID = %(id)s'''
+    query = '''UPDATE listing SET quantity = quantity-%(quantity)s WHERE ID = %(id)s RETURNING account_email'''
     g.cursor.execute(query, {'id': id, 'quantity': quantity})
     g.connection.commit()
+    listings_changed(g.cursor.fetchall())
     return g.cursor.rowcount
 
 
+class InsufficientStock(Exception):
+    """Raised by checkout when listings are sold out, expired or short; nothing was bought"""
+
+    def __init__(self, listing_ids):
+        super(InsufficientStock, self).__init__('Not enough stock for listings {}'.format(listing_ids))
+        self.listing_ids = listing_ids
+
+
+CHECKOUT_LOCK = '''SELECT id, quantity, expired, account_email FROM listing WHERE id = ANY(%(ids)s)
+                   ORDER BY id FOR UPDATE'''
+
+CHECKOUT_BUY = '''
+WITH cart AS (
+  SELECT * FROM unnest(%(ids)s::INTEGER[], %(amounts)s::DOUBLE PRECISION[]) AS cart (id, amount)
+), bought AS (
+  UPDATE listing SET quantity = listing.quantity - cart.amount
+  FROM cart WHERE listing.id = cart.id
+  RETURNING listing.id, listing.price, listing.account_email, cart.amount
+)
+INSERT INTO transaction (cost, status, time, listing_id, buyer_id, seller_id)
+SELECT bought.price * bought.amount, 'paid', now(), bought.id, buyer.id, seller.id
+FROM bought JOIN account seller ON seller.email = bought.account_email, account buyer
+WHERE buyer.email = %(buyer_email)s
+RETURNING id
+'''
+
+
+def checkout(buyer_email, cart):
+    """Buy every {listing_id: amount} in cart in one transaction and return the new transaction ids.
+
+    The listing rows are locked in id order, so two checkouts sharing listings queue behind each
+    other instead of deadlocking. If any listing can't cover its amount, nothing is bought.
+    """
+    if not cart:
+        return []
+    ids = sorted(cart)
+    amounts = [cart[listing_id] for listing_id in ids]
+
+    g.cursor.execute(CHECKOUT_LOCK, {'ids': ids})
+    locked = g.cursor.fetchall()
+    available = {row['id']: row['quantity'] for row in locked if not row['expired']}
+    short = [listing_id for listing_id in ids if (available.get(listing_id) or 0) < cart[listing_id]]
+    if short:
+        g.connection.rollback()
+        raise InsufficientStock(short)
+
+    g.cursor.execute(CHECKOUT_BUY, {'ids': ids, 'amounts': amounts, 'buyer_email': buyer_email})
+    transaction_ids = [row[0] for row in g.cursor.fetchall()]
+    g.connection.commit()
+    listings_changed([(row['account_email'],) for row in locked])
+    return transaction_ids
+
+
+def listings_changed(rows):
+    """Drop the cached listings of every account_email in rows and schedule a feed snapshot refresh"""
+    invalidate_profiles([('listings', row[0]) for row in rows])
+    if rows:
+        feed_snapshot.listings_changed()
+
+
+def invalidate_profiles(keys):
+    """Drop profile_cache keys in this worker and tell the other workers to drop them too.
+
+    Call after committing the write, so no worker can reload the old rows once it is told.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return
+    for key in keys:
+        profile_cache.invalidate(key)
+    # A cursor of its own, so g.cursor keeps the write's rowcount and results for the caller
+    with g.connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%(channel)s, key) FROM unnest(%(keys)s::TEXT[]) AS key',
+                       {'channel': PROFILE_CACHE_CHANNEL, 'keys': ['{}:{}'.format(kind, email) for kind, email in keys]})
+    g.connection.commit()
+
+
+def listen_for_invalidations(data_source_name, stop):
+    """Apply the profile_cache invalidations sent by every worker until stop is set"""
+    connection = None
+    while not stop.is_set():
+        try:
+            if connection is None:
+                connection = psycopg2.connect(data_source_name)
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN ' + PROFILE_CACHE_CHANNEL)
+                # Anything sent while this worker wasn't listening is lost, so start from empty
+                profile_cache.clear()
+
+            if select.select([connection], [], [], 1)[0]:
+                connection.poll()
+                while connection.notifies:
+                    kind, email = connection.notifies.pop(0).payload.split(':', 1)
+                    profile_cache.invalidate((kind, email))
+        except Exception:
+            logger.exception('Profile cache listener failed')
+            if connection is not None:
+                connection.close()
+                connection = None
+            stop.wait(1)
+    if connection is not None:
+        connection.close()
+
+
+def start_invalidation_listener(data_source_name):
+    stop = threading.Event()
+    thread = threading.Thread(target=listen_for_invalidations, args=(data_source_name, stop),
+                              name='profile-cache', daemon=True)
+    thread.start()
+    return stop
+
+
 def get_id_from_email(emailParam):
     g.cursor.execute('SELECT id FROM account WHERE email = %(emailParam)s', {'emailParam': emailParam})
     return g.cursor.fetchone()[0]
@@ -112,10 +273,23 @@ def listings_by_account(account_email):
     return g.cursor.fetchall()
 
 
+def cached_find_account(email):
+    return profile_cache.get(('account', email), lambda: find_account(email))
+
+
+def cached_listings_by_account(account_email):
+    return profile_cache.get(('listings', account_email), lambda: listings_by_account(account_email))
+
+
+def cached_list_favorites(email):
+    return profile_cache.get(('favorites', email), lambda: list_favorites(email))
+
+
 def add_listing_photo_path(listing_id, file_path):
-    g.cursor.execute("UPDATE listing SET file_path = %(file_path)s WHERE id = %(listing_id)s",
+    g.cursor.execute("UPDATE listing SET file_path = %(file_path)s WHERE id = %(listing_id)s RETURNING account_email",
                      {'file_path': file_path, 'listing_id': listing_id})
     g.connection.commit()
+    listings_changed(g.cursor.fetchall())
 
 
 def init_listing_photo(listing_id):
@@ -156,6 +330,24 @@ def fetch_feed(num_listings, email=None):
     return g.cursor.fetchall()
 
 
+def active_listing_name_counts():
+    g.cursor.execute('SELECT name, COUNT(*) FROM listing WHERE quantity > 0 AND NOT expired GROUP BY name')
+    return g.cursor.fetchall()
+
+
+def fetch_feed_snapshot(num_listings, email, max_staleness):
+    """Feed rows from feed_snapshot, or None if the snapshot is older than max_staleness seconds"""
+    g.cursor.execute('SELECT feed_snapshot.*, extract(epoch FROM now() - feed_snapshot_refreshed.refreshed) AS age '
+                     'FROM feed_snapshot, feed_snapshot_refreshed '
+                     'WHERE %(email)s != account_email '
+                     'ORDER BY time_posted, id '
+                     'LIMIT %(num_listings)s', {'num_listings': num_listings, 'email': email})
+    rows = g.cursor.fetchall()
+    if not rows or rows[0]['age'] > max_staleness:
+        return None
+    return rows
+
+
 def check_expire_listing(listing_id):
     g.cursor.execute('SELECT time_posted FROM listing WHERE id = %(listing_id)s', {'listing_id': listing_id})
     time_posted = g.cursor.fetchone()[0]
@@ -166,10 +358,14 @@ def check_expire_listing(listing_id):
 
 
 def check_expire_all():
-    g.cursor.execute('SELECT id FROM listing WHERE expired = FALSE')
-    ids = g.cursor.fetchall()
-    for x in ids:
-        check_expire_listing(x[0])
+    # Same rule as check_expire_listing (more than 10 whole days old), applied in one statement.
+    # Rows locked by a checkout are skipped rather than waited on; the next sweep expires them.
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=11)
+    g.cursor.execute('UPDATE listing SET expired = TRUE WHERE id = ANY(ARRAY('
+                     'SELECT id FROM listing WHERE expired = FALSE AND time_posted <= %(cutoff)s FOR UPDATE SKIP LOCKED)) '
+                     'RETURNING account_email', {'cutoff': cutoff})
+    g.connection.commit()
+    listings_changed(g.cursor.fetchall())
 
 
 def mark_favorite(account_email, favorites_email):
@@ -177,6 +373,7 @@ def mark_favorite(account_email, favorites_email):
                VALUES (%(account_email)s, %(favorites_email)s)'''
     g.cursor.execute(query, {'account_email': account_email, 'favorites_email': favorites_email})
     g.connection.commit()
+    invalidate_profiles([('favorites', account_email)])
 
 
 def list_favorites(email):
@@ -184,6 +381,28 @@ def list_favorites(email):
     return g.cursor.fetchall()
 
 
+def unread_notification_count(email):
+    g.cursor.execute('SELECT unread FROM notification_count WHERE account_email = %(email)s', {'email': email})
+    row = g.cursor.fetchone()
+    return row[0] if row is not None else 0
+
+
+def list_notifications(email, num_notifications):
+    g.cursor.execute('SELECT * FROM notification WHERE account_email = %(email)s '
+                     'ORDER BY updated DESC LIMIT %(num_notifications)s',
+                     {'email': email, 'num_notifications': num_notifications})
+    return g.cursor.fetchall()
+
+
+def mark_notifications_read(email):
+    # Reset the counter first: its row lock orders this against a fan-out delivering to the same account
+    g.cursor.execute('UPDATE notification_count SET unread = 0 WHERE account_email = %(email)s', {'email': email})
+    g.cursor.execute('UPDATE notification SET read = TRUE WHERE account_email = %(email)s AND read = FALSE',
+                     {'email': email})
+    g.connection.commit()
+    return g.cursor.rowcount
+
+
 # Fetch_messages takes in the recipient and listing and renders
 def fetch_messages(me, you):
     # g.cursor.execute('SELECT * FROM message WHERE author = %{me}s AND recepient = %{you}s OR WHERE author=%{you}% AND recepient=%{me}%')
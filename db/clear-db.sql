@@ -1,5 +1,8 @@
 -- CAUTION!! WILL REMOVE ALL DATA FROM DB. USE WITH CARE
 
+DELETE FROM notification;
+DELETE FROM notification_count;
+DELETE FROM notification_outbox;
 DELETE FROM message;
 DELETE FROM photo;
 DELETE FROM listing_tag;
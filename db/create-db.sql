@@ -1,7 +1,11 @@
+DROP MATERIALIZED VIEW IF EXISTS feed_snapshot;
+DROP TABLE IF EXISTS feed_snapshot_refreshed;
+DROP TABLE IF EXISTS notification, notification_count, notification_outbox;
 DROP TABLE IF EXISTS transaction;
 DROP TABLE IF EXISTS message;
 DROP TABLE IF EXISTS photo, listing_tag, tag, listing;
 DROP TABLE IF EXISTS account_favorites, account;
+DROP TABLE IF EXISTS schema_migrations;
 
 CREATE TABLE account
 (
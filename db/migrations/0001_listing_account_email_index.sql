@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- listings_by_account, and the seller's listings on every profile page
+DROP INDEX CONCURRENTLY IF EXISTS listing_account_email_idx;
+CREATE INDEX CONCURRENTLY listing_account_email_idx ON listing (account_email);
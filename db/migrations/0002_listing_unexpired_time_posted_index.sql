@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- fetch_feed (unexpired listings by time_posted) and check_expire_all (unexpired listings older than the cutoff).
+-- Partial, so expired listings never make the index bigger.
+DROP INDEX CONCURRENTLY IF EXISTS listing_unexpired_time_posted_idx;
+CREATE INDEX CONCURRENTLY listing_unexpired_time_posted_idx ON listing (time_posted) WHERE expired = FALSE;
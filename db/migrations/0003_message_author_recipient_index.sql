@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- fetch_messages looks up a conversation in both directions
+DROP INDEX CONCURRENTLY IF EXISTS message_author_recipient_idx;
+CREATE INDEX CONCURRENTLY message_author_recipient_idx ON message (author, recipient);
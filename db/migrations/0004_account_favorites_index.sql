@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- list_favorites
+DROP INDEX CONCURRENTLY IF EXISTS account_favorites_account_email_idx;
+CREATE INDEX CONCURRENTLY account_favorites_account_email_idx ON account_favorites (account_email, favorites_email);
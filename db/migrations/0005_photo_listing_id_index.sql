@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- get_first_photo_path and init_listing_photo
+DROP INDEX CONCURRENTLY IF EXISTS photo_listing_id_idx;
+CREATE INDEX CONCURRENTLY photo_listing_id_idx ON photo (listing_id);
@@ -0,0 +1,41 @@
+-- New-listing notifications for the followers of a seller (see notifications.py)
+
+-- Listings whose followers have not all been notified yet
+CREATE TABLE notification_outbox
+(
+  id            SERIAL       NOT NULL
+    CONSTRAINT notification_outbox_pk
+    PRIMARY KEY,
+  seller_email  VARCHAR(128) NOT NULL REFERENCES account (email),
+  listing_id    INTEGER      NOT NULL REFERENCES listing (id),
+  listing_count INTEGER      NOT NULL DEFAULT 1,
+  last_follower VARCHAR(128) DEFAULT NULL,
+  created       TIMESTAMP    NOT NULL DEFAULT now()
+);
+
+-- One unread notification per follower and seller; later listings are folded into it
+CREATE TABLE notification
+(
+  id            SERIAL       NOT NULL
+    CONSTRAINT notification_pk
+    PRIMARY KEY,
+  account_email VARCHAR(128) NOT NULL REFERENCES account (email),
+  seller_email  VARCHAR(128) NOT NULL REFERENCES account (email),
+  listing_id    INTEGER      NOT NULL REFERENCES listing (id),
+  listing_count INTEGER      NOT NULL DEFAULT 1,
+  created       TIMESTAMP    NOT NULL DEFAULT now(),
+  updated       TIMESTAMP    NOT NULL DEFAULT now(),
+  read          BOOLEAN      NOT NULL DEFAULT FALSE
+);
+
+CREATE UNIQUE INDEX notification_unread_uindex ON notification (account_email, seller_email) WHERE read = FALSE;
+CREATE INDEX notification_account_email_idx ON notification (account_email, updated);
+
+-- Unread notifications per account, kept up to date by the fan-out and mark-read queries
+CREATE TABLE notification_count
+(
+  account_email VARCHAR(128) NOT NULL
+    CONSTRAINT notification_count_pk
+    PRIMARY KEY REFERENCES account (email),
+  unread        INTEGER      NOT NULL DEFAULT 0
+);
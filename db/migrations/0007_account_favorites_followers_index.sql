@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- Notification fan-out pages through a seller's followers in account_email order
+DROP INDEX CONCURRENTLY IF EXISTS account_favorites_favorites_email_idx;
+CREATE INDEX CONCURRENTLY account_favorites_favorites_email_idx ON account_favorites (favorites_email, account_email);
@@ -0,0 +1,11 @@
+-- Active listings for the feed with the seller's name, refreshed by feed_snapshot.py.
+-- refreshed is the time of the refresh that produced the row, used to bound staleness.
+CREATE MATERIALIZED VIEW feed_snapshot AS
+  SELECT listing.*, account.first_name || ' ' || account.last_name AS seller_name, now() AS refreshed
+  FROM listing JOIN account ON account.email = listing.account_email
+  WHERE listing.quantity > 0 AND NOT listing.expired
+  ORDER BY listing.time_posted, listing.id;
+
+-- Required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX feed_snapshot_id_uindex ON feed_snapshot (id);
+CREATE INDEX feed_snapshot_time_posted_idx ON feed_snapshot (time_posted, id);
@@ -0,0 +1,22 @@
+-- Keep the refresh time out of feed_snapshot's rows: with now() in every row, each
+-- REFRESH ... CONCURRENTLY rewrote the whole view even when no listing had changed.
+-- feed_snapshot.refresh() updates the single feed_snapshot_refreshed row in the same transaction.
+DROP MATERIALIZED VIEW feed_snapshot;
+
+CREATE MATERIALIZED VIEW feed_snapshot AS
+  SELECT listing.*, account.first_name || ' ' || account.last_name AS seller_name
+  FROM listing JOIN account ON account.email = listing.account_email
+  WHERE listing.quantity > 0 AND NOT listing.expired
+  ORDER BY listing.time_posted, listing.id;
+
+-- Required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX feed_snapshot_id_uindex ON feed_snapshot (id);
+CREATE INDEX feed_snapshot_time_posted_idx ON feed_snapshot (time_posted, id);
+
+CREATE TABLE feed_snapshot_refreshed
+(
+  only_row  BOOLEAN                  NOT NULL DEFAULT TRUE PRIMARY KEY CHECK (only_row),
+  refreshed TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+INSERT INTO feed_snapshot_refreshed (refreshed) VALUES (now());
@@ -0,0 +1,82 @@
+import datetime
+from urllib.parse import urlencode
+
+import asyncpg
+import psycopg2.extensions
+
+# Shared by every request in the worker; opened by open_pool() once the event loop is running
+pool = None
+
+
+def connect_kwargs(data_source_name):
+    """asyncpg connect() arguments for the libpq 'host=... dbname=...' string or URI psycopg2 uses"""
+    # psycopg2 handles the quoting. asyncpg reads the same keys from a URI's query string,
+    # except connect_timeout, which it takes as the timeout argument.
+    params = psycopg2.extensions.parse_dsn(data_source_name)
+    kwargs = {}
+    if 'connect_timeout' in params:
+        kwargs['timeout'] = float(params.pop('connect_timeout'))
+    kwargs['dsn'] = 'postgresql://?' + urlencode(params)
+    return kwargs
+
+
+async def open_pool(data_source_name, min_size=2, max_size=10):
+    global pool
+    pool = await asyncpg.create_pool(min_size=min_size, max_size=max_size, **connect_kwargs(data_source_name))
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+async def find_account(email):
+    return await pool.fetchrow('SELECT * FROM account WHERE email = $1', email)
+
+
+async def get_id_from_email(email):
+    return await pool.fetchval('SELECT id FROM account WHERE email = $1', email)
+
+
+async def listings_by_account(account_email):
+    return await pool.fetch('SELECT * FROM listing WHERE account_email = $1 AND expired = FALSE', account_email)
+
+
+async def fetch_feed(num_listings, email=None):
+    return await pool.fetch('SELECT * '
+                            'FROM listing '
+                            'WHERE quantity > 0 AND NOT expired AND $1 != listing.account_email '
+                            'ORDER BY time_posted '
+                            'LIMIT $2', email, num_listings)
+
+
+async def fetch_feed_snapshot(num_listings, email, max_staleness):
+    """Feed rows from feed_snapshot, or None if the snapshot is older than max_staleness seconds"""
+    rows = await pool.fetch('SELECT feed_snapshot.*, extract(epoch FROM now() - feed_snapshot_refreshed.refreshed) AS age '
+                            'FROM feed_snapshot, feed_snapshot_refreshed '
+                            'WHERE $1 != account_email '
+                            'ORDER BY time_posted, id '
+                            'LIMIT $2', email, num_listings)
+    if not rows or rows[0]['age'] > max_staleness:
+        return None
+    return rows
+
+
+async def check_expire_all():
+    # Same as db.check_expire_all: rows locked by a checkout are skipped rather than waited on
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=11)
+    await pool.execute('UPDATE listing SET expired = TRUE WHERE id = ANY(ARRAY('
+                       'SELECT id FROM listing WHERE expired = FALSE AND time_posted <= $1 FOR UPDATE SKIP LOCKED))',
+                       cutoff)
+
+
+async def list_favorites(email):
+    return await pool.fetch('SELECT * FROM account_favorites WHERE account_email = $1', email)
+
+
+async def fetch_messages(me, you):
+    return await pool.fetch('SELECT * '
+                            'FROM message '
+                            'WHERE author = $1 AND recipient = $2 OR author = $2 AND recipient = $1', me, you)
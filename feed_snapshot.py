@@ -0,0 +1,87 @@
+"""Keeps the feed_snapshot materialized view fresh for render_feed (when FEED_SNAPSHOT is on).
+
+A refresher thread in each worker runs REFRESH MATERIALIZED VIEW CONCURRENTLY every
+`interval` seconds, and sooner after a listing changes: listings_changed() schedules a
+refresh `debounce` seconds later, so a burst of changes costs one refresh. Readers are
+never blocked by a concurrent refresh, and an advisory lock keeps workers from
+refreshing at the same time.
+"""
+import logging
+import threading
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+ADVISORY_LOCK_ID = 7310413
+
+# The running FeedRefresher of this process, if any
+refresher = None
+
+
+def refresh(connection):
+    """Refresh the snapshot unless another process already is. Returns True if this call did"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (ADVISORY_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            connection.rollback()
+            return False
+        cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY feed_snapshot')
+        # now() is when this transaction began, so the recorded age never understates the real one
+        cursor.execute('UPDATE feed_snapshot_refreshed SET refreshed = now()')
+    connection.commit()
+    return True
+
+
+def listings_changed():
+    if refresher is not None:
+        refresher.request_refresh()
+
+
+class FeedRefresher(object):
+    def __init__(self, data_source_name, interval=10, debounce=1):
+        self.data_source_name = data_source_name
+        self.interval = interval
+        self.debounce = debounce
+        self._requested = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='feed-snapshot', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._requested.set()
+
+    def request_refresh(self):
+        self._requested.set()
+
+    def _run(self):
+        connection = None
+        while not self._stop.is_set():
+            if self._requested.wait(self.interval):
+                # Let the rest of a burst of changes arrive before refreshing
+                self._stop.wait(self.debounce)
+            self._requested.clear()
+            if self._stop.is_set():
+                break
+
+            try:
+                if connection is None:
+                    connection = psycopg2.connect(self.data_source_name)
+                refresh(connection)
+            except Exception:
+                logger.exception('Feed snapshot refresh failed')
+                if connection is not None:
+                    connection.close()
+                    connection = None
+        if connection is not None:
+            connection.close()
+
+
+def start_refresher(data_source_name, interval=10, debounce=1):
+    global refresher
+    refresher = FeedRefresher(data_source_name, interval, debounce)
+    refresher.start()
+    return refresher
@@ -0,0 +1,15 @@
+# gunicorn -c gunicorn.conf.py 'application:create_app()'
+#
+# The app is built once in the master and shared with the forked workers. Each worker opens
+# its own database pool after the fork.
+import application
+
+preload_app = True
+
+
+def when_ready(server):
+    application.preload(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    application.init_worker(worker.app.wsgi())
@@ -0,0 +1,109 @@
+"""Apply the pending SQL files in db/migrations to the database: python migrate.py
+
+Migrations are forward-only and run in version order. Each one is recorded in the
+schema_migrations table so it is applied exactly once. A file starting with
+'-- migrate: no-transaction' runs statement by statement outside a transaction,
+which CREATE INDEX CONCURRENTLY requires; write such files so they can be re-run
+after a failure (e.g. DROP INDEX CONCURRENTLY IF EXISTS before creating it).
+"""
+import os
+import re
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db', 'migrations')
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+# Held while migrating so two deploys can't apply the same migration at once
+ADVISORY_LOCK_ID = 7310412
+
+
+def available_migrations(directory=MIGRATIONS_DIR):
+    """(version, name, path) for every migration file, oldest first"""
+    migrations = []
+    for file_name in os.listdir(directory):
+        match = re.match(r'(\d+)_(\w+)\.sql$', file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, file_name)))
+    return sorted(migrations)
+
+
+def applied_versions(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+                          (
+                            version    INTEGER      NOT NULL PRIMARY KEY,
+                            name       VARCHAR(128) NOT NULL,
+                            applied_at TIMESTAMP    NOT NULL DEFAULT now()
+                          )''')
+        cursor.execute('SELECT version FROM schema_migrations')
+        versions = {row[0] for row in cursor.fetchall()}
+    connection.commit()
+    return versions
+
+
+def split_statements(sql):
+    return [statement.strip() for statement in re.split(r';\s*$', sql, flags=re.MULTILINE) if statement.strip()]
+
+
+def apply_migration(connection, version, name, sql):
+    if sql.startswith(NO_TRANSACTION):
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                for statement in split_statements(sql):
+                    cursor.execute(statement)
+        finally:
+            connection.autocommit = False
+
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+    connection.commit()
+
+
+def migrate(connection, directory=MIGRATIONS_DIR):
+    """Apply every migration newer than the database and return the names applied"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', (ADVISORY_LOCK_ID,))
+    connection.commit()
+
+    try:
+        migrations = available_migrations(directory)
+        applied = applied_versions(connection)
+
+        unknown = applied - {version for version, _, _ in migrations}
+        if unknown:
+            raise RuntimeError('Database has migrations this code does not know about: {}'.format(sorted(unknown)))
+
+        done = []
+        for version, name, path in migrations:
+            if version in applied:
+                continue
+            with open(path) as f:
+                apply_migration(connection, version, name, f.read())
+            done.append('{:04d}_{}'.format(version, name))
+        return done
+    finally:
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (ADVISORY_LOCK_ID,))
+        connection.commit()
+
+
+if __name__ == '__main__':
+    import application
+
+    connection = psycopg2.connect(application.load_config()['DATA_SOURCE_NAME'])
+    try:
+        applied_names = migrate(connection)
+    finally:
+        connection.close()
+
+    for applied_name in applied_names:
+        print('Applied', applied_name)
+    if not applied_names:
+        print('Database is up to date')
@@ -0,0 +1,131 @@
+"""Deliver new-listing notifications to the followers of the seller.
+
+db.create_listing only adds a row to notification_outbox. A worker (a thread started by
+application.init_worker, or `python notifications.py` on its own) fans each row out to the
+seller's followers in batches, one INSERT ... SELECT per batch. Batches commit together
+with the outbox row's progress, so a crashed worker resumes where it stopped.
+
+Notifications are digests: a follower has at most one unread notification per seller, and
+further listings from that seller bump its listing_count instead of adding another.
+"""
+import logging
+import threading
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+POLL_INTERVAL = 1
+
+FAN_OUT_BATCH = '''
+WITH followers AS (
+  SELECT DISTINCT account_email
+  FROM account_favorites
+  WHERE favorites_email = %(seller_email)s AND account_email > %(after)s
+  ORDER BY account_email
+  LIMIT %(batch_size)s
+), delivered AS (
+  INSERT INTO notification (account_email, seller_email, listing_id, listing_count)
+  SELECT account_email, %(seller_email)s, %(listing_id)s, %(listing_count)s FROM followers
+  ON CONFLICT (account_email, seller_email) WHERE read = FALSE
+  DO UPDATE SET listing_id = EXCLUDED.listing_id, listing_count = notification.listing_count + EXCLUDED.listing_count,
+                updated = now()
+  RETURNING account_email, xmax = 0 AS inserted
+), counted AS (
+  INSERT INTO notification_count (account_email, unread)
+  SELECT account_email, 1 FROM delivered WHERE inserted
+  ON CONFLICT (account_email) DO UPDATE SET unread = notification_count.unread + 1
+)
+SELECT max(account_email), count(*) FROM followers
+'''
+
+
+def claim_next(cursor):
+    """Lock the oldest outbox row no other worker is on, folding in the seller's other waiting listings"""
+    cursor.execute('SELECT id, seller_email, listing_id, listing_count, last_follower FROM notification_outbox '
+                   'ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED')
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    outbox_id, seller_email, listing_id, listing_count, last_follower = row
+
+    if last_follower is None:
+        cursor.execute('DELETE FROM notification_outbox WHERE id IN '
+                       '(SELECT id FROM notification_outbox '
+                       ' WHERE seller_email = %(seller_email)s AND id > %(id)s AND last_follower IS NULL '
+                       ' FOR UPDATE SKIP LOCKED) '
+                       'RETURNING listing_id, listing_count',
+                       {'seller_email': seller_email, 'id': outbox_id})
+        for later_listing_id, later_count in cursor.fetchall():
+            listing_id = max(listing_id, later_listing_id)
+            listing_count += later_count
+
+    return outbox_id, seller_email, listing_id, listing_count, last_follower
+
+
+def deliver_batch(connection, batch_size=BATCH_SIZE):
+    """Fan out one batch for one outbox row. Returns False when there was nothing to do"""
+    with connection.cursor() as cursor:
+        claimed = claim_next(cursor)
+        if claimed is None:
+            connection.rollback()
+            return False
+        outbox_id, seller_email, listing_id, listing_count, last_follower = claimed
+
+        cursor.execute(FAN_OUT_BATCH, {'seller_email': seller_email, 'listing_id': listing_id,
+                                       'listing_count': listing_count, 'after': last_follower or '',
+                                       'batch_size': batch_size})
+        last_follower, delivered = cursor.fetchone()
+
+        if delivered < batch_size:
+            cursor.execute('DELETE FROM notification_outbox WHERE id = %(id)s', {'id': outbox_id})
+        else:
+            cursor.execute('UPDATE notification_outbox SET listing_id = %(listing_id)s, '
+                           'listing_count = %(listing_count)s, last_follower = %(last_follower)s WHERE id = %(id)s',
+                           {'id': outbox_id, 'listing_id': listing_id, 'listing_count': listing_count,
+                            'last_follower': last_follower})
+    connection.commit()
+    return True
+
+
+def deliver_pending(connection, batch_size=BATCH_SIZE):
+    """Deliver everything in the outbox and return the number of batches run"""
+    batches = 0
+    while deliver_batch(connection, batch_size):
+        batches += 1
+    return batches
+
+
+def run_worker(data_source_name, stop=None):
+    stop = stop or threading.Event()
+    connection = None
+    while not stop.is_set():
+        try:
+            if connection is None:
+                connection = psycopg2.connect(data_source_name)
+            if deliver_pending(connection) == 0:
+                stop.wait(POLL_INTERVAL)
+        except Exception:
+            # Anything uncaught would end the thread, and with it delivery, without a trace
+            logger.exception('Notification worker failed')
+            if connection is not None:
+                connection.close()
+                connection = None
+            stop.wait(POLL_INTERVAL)
+    if connection is not None:
+        connection.close()
+
+
+def start_worker(data_source_name):
+    stop = threading.Event()
+    thread = threading.Thread(target=run_worker, args=(data_source_name, stop), name='notifications', daemon=True)
+    thread.start()
+    return stop
+
+
+if __name__ == '__main__':
+    import application
+
+    logging.basicConfig(level=logging.INFO)
+    run_worker(application.load_config()['DATA_SOURCE_NAME'])
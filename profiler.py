@@ -0,0 +1,131 @@
+"""Sampling profiles of single requests, written as collapsed stacks for flame graphs.
+
+While a request is profiled, a thread samples the request thread's Python stack every
+`interval` seconds. When the request ends, the samples are written to
+<directory>/<time>-<pid>-<endpoint>.folded, one 'outer;...;inner count' line per distinct
+stack (the format flamegraph.pl and speedscope read), next to a .json file with the
+route and the request's query count and time. Only the newest `max_files` profiles are kept.
+"""
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+# Frames from installed packages are labelled relative to site-packages, the rest to the app
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def frame_label(code):
+    path = code.co_filename
+    if 'site-packages' + os.sep in path:
+        path = path.split('site-packages' + os.sep, 1)[1]
+    elif path.startswith(APP_ROOT + os.sep):
+        path = os.path.relpath(path, APP_ROOT)
+    return '{} ({}:{})'.format(code.co_name, path, code.co_firstlineno)
+
+
+def collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def in_stop(frame):
+    while frame is not None:
+        if frame.f_code is Profile.stop.__code__:
+            return True
+        frame = frame.f_back
+    return False
+
+
+class Profile(object):
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.started = None
+        self.seconds = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            # A sample taken as stop() is called shows the thread stopping the profiler,
+            # not the request: the wait above can time out just before stop() sets the event
+            if self._stop.is_set() or in_stop(frame):
+                return
+            self.stacks[collapse(frame)] += 1
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def write(self, directory, name, tags, max_files):
+        """Write name.folded and name.json to directory, then prune it to max_files profiles"""
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, '{}-{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                                                        os.getpid(), name))
+        with open(stem + '.folded', 'w') as f:
+            f.write(self.collapsed())
+
+        tags = dict(tags, duration_ms=round(self.seconds * 1000, 3), samples=sum(self.stacks.values()),
+                    interval_ms=self.interval * 1000, queries=self.queries,
+                    query_ms=round(self.query_seconds * 1000, 3))
+        with open(stem + '.json', 'w') as f:
+            json.dump(tags, f, indent=2)
+
+        prune(directory, max_files)
+        return stem + '.folded'
+
+
+def prune(directory, max_files):
+    # File names start with the time, so sorting them puts the oldest first
+    profiles = sorted(file_name for file_name in os.listdir(directory) if file_name.endswith('.folded'))
+    for file_name in profiles[:max(len(profiles) - max_files, 0)]:
+        stem = os.path.join(directory, file_name[:-len('.folded')])
+        for path in (stem + '.folded', stem + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another worker pruned it first
+                pass
+
+
+class CountingCursor(object):
+    """Wraps a cursor to add the number and duration of its queries to a Profile"""
+
+    def __init__(self, cursor, profile):
+        self.cursor = cursor
+        self.profile = profile
+
+    def execute(self, query, params=None):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(query, params)
+        finally:
+            self.profile.queries += 1
+            self.profile.query_seconds += time.perf_counter() - start
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
@@ -0,0 +1,175 @@
+import collections
+import math
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend(object):
+    """Token buckets kept in this process. Each worker gets its own buckets.
+
+    At most max_keys buckets are kept; when a new key would exceed that, the bucket used
+    least recently is forgotten, so a flood of new keys costs O(1) per request.
+    """
+
+    # Exceptions take() raises when the backend is unavailable
+    errors = ()
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket for `key`. Returns 0 if allowed, else seconds until a token is free"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBackend(object):
+    """Token buckets shared by every worker through Redis"""
+
+    errors = (redis.RedisError,) if redis is not None else ()
+
+    script = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError('The redis package is required for a shared rate limit backend')
+        self.prefix = prefix
+        self._take = redis.StrictRedis.from_url(url).register_script(self.script)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst, time.time()]))
+
+
+class Limit(object):
+    """Admission settings for one endpoint.
+
+    rate and burst configure a token bucket per account (or per IP for guests and key='ip').
+    concurrency caps how many requests to the endpoint may be in flight at once.
+    """
+
+    def __init__(self, rate=None, burst=None, key='account', methods=None, concurrency=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.key = key
+        self.methods = methods
+        self.concurrency = concurrency
+        self.gate = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+
+class Admission(object):
+    """Per-endpoint token-bucket rate limits plus a global concurrency gate.
+
+    admit() returns (status, retry_after) for a request that should be turned away,
+    or None once the request has been let in; every admitted request must be released.
+    While the backend is unavailable, rate limits use buckets kept in this process instead.
+    """
+
+    def __init__(self, max_concurrent, backend=None, retry_after=1):
+        self.max_concurrent = max_concurrent
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.fallback = MemoryBackend()
+        self.backend_errors = 0
+        self.retry_after = retry_after
+        self.limits = {}
+        self._gate = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {}
+
+    def limit(self, endpoint, **kwargs):
+        self.limits[endpoint] = Limit(**kwargs)
+
+    def admit(self, endpoint, method, account, ip):
+        limit = self.limits.get(endpoint)
+        if limit is not None and limit.methods and method not in limit.methods:
+            limit = None
+
+        if limit is not None and limit.rate:
+            key = '{}:{}'.format(endpoint, account if limit.key == 'account' and account else ip)
+            try:
+                wait = self.backend.take(key, limit.rate, limit.burst)
+            except self.backend.errors:
+                with self._lock:
+                    self.backend_errors += 1
+                wait = self.fallback.take(key, limit.rate, limit.burst)
+            if wait > 0:
+                self._count(endpoint, 'rate_limited')
+                return 429, max(1, int(math.ceil(wait)))
+
+        if not self._gate.acquire(blocking=False):
+            self._count(endpoint, 'overloaded')
+            return 503, self.retry_after
+
+        if limit is not None and limit.gate is not None and not limit.gate.acquire(blocking=False):
+            self._gate.release()
+            self._count(endpoint, 'overloaded')
+            return 503, self.retry_after
+
+        with self._lock:
+            self.in_flight += 1
+        self._count(endpoint, 'admitted')
+        return None
+
+    def release(self, endpoint, method):
+        limit = self.limits.get(endpoint)
+        if limit is not None and limit.gate is not None and not (limit.methods and method not in limit.methods):
+            limit.gate.release()
+        self._gate.release()
+        with self._lock:
+            self.in_flight -= 1
+
+    def _count(self, endpoint, outcome):
+        with self._lock:
+            key = (str(endpoint), outcome)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def metrics(self):
+        """Counters in the Prometheus text format"""
+        lines = ['# TYPE admission_requests_total counter']
+        with self._lock:
+            for (endpoint, outcome), count in sorted(self.counters.items()):
+                lines.append('admission_requests_total{{endpoint="{}",outcome="{}"}} {}'.format(endpoint, outcome, count))
+            lines.append('# TYPE admission_in_flight gauge')
+            lines.append('admission_in_flight {}'.format(self.in_flight))
+            lines.append('# TYPE admission_backend_errors_total counter')
+            lines.append('admission_backend_errors_total {}'.format(self.backend_errors))
+        lines.append('# TYPE admission_max_concurrent gauge')
+        lines.append('admission_max_concurrent {}'.format(self.max_concurrent))
+        return '\n'.join(lines) + '\n'
@@ -1,6 +1,25 @@
+import asyncio
+import inspect
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.parse
+import asgi
+import cache
 import db
-from application import app, Account, login_user, logout_user, AccountForm
+import db_async
+import feed_snapshot
+import migrate
+import notifications
+import autocomplete
+import profiler
+import ratelimit
+from application import app, create_app, Account, login_user, logout_user, AccountForm, listing_names, load_listing_names
 from flask import g, url_for
 
 
@@ -28,6 +47,8 @@ class ApplicationTestCase(FlaskTestCase):
         super(ApplicationTestCase, self).setUp()
         db.open_db_connection()
         self.execute_sql('DB/create-db.sql')
+        migrate.migrate(g.connection)
+        db.profile_cache.clear()
 
     def tearDown(self):
         db.close_db_connection()
@@ -109,6 +130,27 @@ class ApplicationTestCase(FlaskTestCase):
         self.assertTrue(b'Bananas' in resp.data)
         self.assertTrue(b'Apples' in resp.data)
 
+    # checkout
+    def test_checkout_csrf(self):
+        db.create_account('buyer@example.com', 'First', 'Last', 'password')
+        db.create_listing('Potatoes', 5, 'Some form of description', 5, 'buyer@example.com', 'grams')
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'buyer@example.com'
+            session['cart'] = {'100': 2}
+
+        # A form posted from another site has no token. Requests share g with the test, so the
+        # test opens its own connection to check the listing and closes it before the next request.
+        self.client.post('/cart/checkout')
+        db.open_db_connection()
+        self.assertEqual(db.find_listing(100)['quantity'], 5)
+        db.close_db_connection()
+
+        resp = self.client.get('/cart')
+        token = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', resp.data).group(1).decode()
+        self.client.post('/cart/checkout', data={'csrf_token': token})
+        db.open_db_connection()
+        self.assertEqual(db.find_listing(100)['quantity'], 3)
+
 
 class DatabaseTestCase(FlaskTestCase):
     @staticmethod
@@ -121,6 +163,8 @@ class DatabaseTestCase(FlaskTestCase):
         super(DatabaseTestCase, self).setUp()
         db.open_db_connection()
         self.execute_sql('DB/create-db.sql')
+        migrate.migrate(g.connection)
+        db.profile_cache.clear()
 
     def tearDown(self):
         db.close_db_connection()
@@ -282,6 +326,125 @@ class DatabaseTestCase(FlaskTestCase):
         self.assertEqual(test_listings[0][0], 100)
         self.assertEqual(test_listings[1][0], 101)
 
+    # notifications
+    def test_notifications(self):
+        db.create_account('seller@example.com', 'First', 'Last', 'password')
+        for i in range(1, 6):
+            db.create_account('follower{0}@example.com'.format(i), 'First', 'Last', 'password')
+            db.mark_favorite('follower{0}@example.com'.format(i), 'seller@example.com')
+
+        db.create_listing('Potatoes', 5, 'Some form of description', 5, 'seller@example.com', 'grams')
+        self.assertEqual(db.unread_notification_count('follower1@example.com'), 0)
+
+        # Five followers in batches of two
+        self.assertEqual(notifications.deliver_pending(g.connection, batch_size=2), 3)
+        for i in range(1, 6):
+            self.assertEqual(db.unread_notification_count('follower{0}@example.com'.format(i)), 1)
+
+        # A burst of listings is folded into the unread notification
+        db.create_listing('Tomatoes', 5, 'Some form of description', 5, 'seller@example.com', 'grams')
+        db.create_listing('Apples', 5, 'Some form of description', 5, 'seller@example.com', 'grams')
+        self.assertEqual(notifications.deliver_pending(g.connection, batch_size=2), 3)
+        self.assertEqual(db.unread_notification_count('follower1@example.com'), 1)
+        test_notifications = db.list_notifications('follower1@example.com', 10)
+        self.assertEqual(len(test_notifications), 1)
+        self.assertEqual(test_notifications[0]['listing_count'], 3)
+        self.assertEqual(test_notifications[0]['listing_id'], 102)
+
+        db.mark_notifications_read('follower1@example.com')
+        self.assertEqual(db.unread_notification_count('follower1@example.com'), 0)
+
+        db.create_listing('Pears', 5, 'Some form of description', 5, 'seller@example.com', 'grams')
+        notifications.deliver_pending(g.connection)
+        self.assertEqual(db.unread_notification_count('follower1@example.com'), 1)
+        self.assertEqual(len(db.list_notifications('follower1@example.com', 10)), 2)
+        self.assertEqual(db.unread_notification_count('follower2@example.com'), 1)
+
+    # profile cache invalidation
+    def test_invalidation_listener(self):
+        db.create_account('one@example.com', 'First', 'Last', 'password')
+        stop = db.start_invalidation_listener(app.config['DATA_SOURCE_NAME'])
+        try:
+            # Another worker's cache is stood in for by an entry this process never invalidated itself
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                db.profile_cache.get(('account', 'one@example.com'), lambda: 'stale')
+                with g.connection.cursor() as cursor:
+                    cursor.execute("NOTIFY profile_cache, 'account:one@example.com'")
+                g.connection.commit()
+                time.sleep(0.1)
+                if db.cached_find_account('one@example.com') != 'stale':
+                    break
+            self.assertEqual(db.cached_find_account('one@example.com')['first_name'], 'First')
+
+            db.update_account('one@example.com', 'Second', 'Last', '', None)
+            self.assertEqual(db.cached_find_account('one@example.com')['first_name'], 'Second')
+        finally:
+            stop.set()
+
+    # load_listing_names
+    def test_load_listing_names(self):
+        db.create_account('one@example.com', 'First', 'Last', 'password')
+        db.create_listing('Peppers', 5, 'Some form of description', 5, 'one@example.com', 'pc')
+        db.create_listing('Peas', 5, 'Some form of description', 5, 'one@example.com', 'pc')
+        db.create_listing('Peas', 5, 'Some form of description', 5, 'one@example.com', 'pc')
+        load_listing_names(app)
+        self.assertEqual(listing_names.complete('pe'), ['Peas', 'Peppers'])
+
+        # Sold out listings stop counting on the next reload
+        db.buy_listing(101, 5)
+        db.buy_listing(102, 5)
+        load_listing_names(app)
+        self.assertEqual(listing_names.complete('pe'), ['Peppers'])
+
+    # checkout
+    def test_checkout(self):
+        db.create_account('buyer@example.com', 'First', 'Last', 'password')
+        db.create_account('one@example.com', 'First', 'Last', 'password')
+        db.create_account('two@example.com', 'First', 'Last', 'password')
+        db.create_listing('Potatoes', 5, 'Some form of description', 2, 'one@example.com', 'pounds')
+        db.create_listing('Watermelons', 3, 'Some form of description', 4, 'two@example.com', 'pc')
+
+        transaction_ids = db.checkout('buyer@example.com', {101: 2, 100: 1.5})
+        self.assertEqual(len(transaction_ids), 2)
+        self.assertEqual(db.find_listing(100)['quantity'], 3.5)
+        self.assertEqual(db.find_listing(101)['quantity'], 1)
+        g.cursor.execute('SELECT listing_id, cost FROM transaction ORDER BY listing_id')
+        self.assertEqual([tuple(row) for row in g.cursor.fetchall()], [(100, 3), (101, 8)])
+
+        # Not enough watermelons left: the potatoes are not bought either
+        with self.assertRaises(db.InsufficientStock) as raised:
+            db.checkout('buyer@example.com', {100: 1, 101: 2})
+        self.assertEqual(raised.exception.listing_ids, [101])
+        self.assertEqual(db.find_listing(100)['quantity'], 3.5)
+        g.cursor.execute('SELECT COUNT(*) FROM transaction')
+        self.assertEqual(g.cursor.fetchone()[0], 2)
+
+        self.assertEqual(db.checkout('buyer@example.com', {}), [])
+
+    # fetch_feed_snapshot
+    def test_fetch_feed_snapshot(self):
+        db.create_account('one@example.com', 'First', 'Last', 'password')
+        db.create_listing('Potatoes', 5, 'Some form of description', 5, 'one@example.com', 'grams')
+        db.create_listing('Watermelons', 0, 'Some form of description', 5, 'one@example.com', 'pounds')
+        self.assertIsNone(db.fetch_feed_snapshot(10, 'two@example.com', 60))
+
+        self.assertTrue(feed_snapshot.refresh(g.connection))
+        test_feed = db.fetch_feed_snapshot(10, 'two@example.com', 60)
+        self.assertEqual(len(test_feed), 1)
+        self.assertEqual(test_feed[0]['name'], 'Potatoes')
+        self.assertEqual(test_feed[0]['seller_name'], 'First Last')
+
+        self.assertIsNone(db.fetch_feed_snapshot(10, 'one@example.com', 60))
+        self.assertIsNone(db.fetch_feed_snapshot(10, 'two@example.com', -1))
+
+        # A refresh with nothing changed leaves the rows alone
+        g.cursor.execute('SELECT xmin::TEXT FROM feed_snapshot')
+        row_versions = g.cursor.fetchall()
+        self.assertTrue(feed_snapshot.refresh(g.connection))
+        g.cursor.execute('SELECT xmin::TEXT FROM feed_snapshot')
+        self.assertEqual(g.cursor.fetchall(), row_versions)
+
     # fetch_feed
     def test_fetch_feed(self):
         test_account = db.create_account('test@example.com', 'First', 'Last', 'password')
@@ -310,6 +473,410 @@ class DatabaseTestCase(FlaskTestCase):
         self.assertEqual(test_feed[0][0], 101)
 
 
+class ExplainingCursor(object):
+    """Wraps a cursor so every query db.py runs is EXPLAINed first, noting the db function that ran it"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, query, params=None):
+        self.cursor.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        self.plans.append((sys._getframe(1).f_code.co_name, query, self.cursor.fetchone()[0][0]['Plan']))
+        return self.cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTestCase(FlaskTestCase):
+    # Tables that grow with the site; a sequential scan over one of them is a regression
+    HOT_TABLES = {'account', 'listing', 'message', 'account_favorites', 'photo', 'notification', 'notification_count',
+                  'feed_snapshot'}
+    COST_BUDGET = 100
+    # Budgets for the db functions whose statements touch many rows by design. The expiry sweep is
+    # estimated by how many listings it might expire, which grows with the data.
+    COST_BUDGETS = {'check_expire_all': 2500, 'all_accounts': 1000, 'all_listings': 5000,
+                    'active_listing_name_counts': 3000}
+    # db functions that read a whole hot table on purpose: the account list pages, and the
+    # per-worker autocomplete reload (every AUTOCOMPLETE_RELOAD_INTERVAL, not per request)
+    FULL_SCANS = {'all_accounts', 'all_listings', 'active_listing_name_counts'}
+
+    SYNTHETIC_DATA = '''
+        INSERT INTO account (email, first_name, last_name, password)
+        SELECT 'user' || i || '@example.com', 'First', 'Last', 'password' FROM generate_series(1, 5000) i;
+
+        INSERT INTO listing (name, quantity, description, price, account_email, unit, time_posted, expired, file_path)
+        SELECT 'Tomatoes', i % 10, 'Synthetic listing', 5, 'user' || (i % 5000 + 1) || '@example.com', 'lb',
+               now() - (i % 30) * interval '1 day', i % 30 > 10, '/static/photos/file' || i || '.jpg'
+        FROM generate_series(1, 50000) i;
+
+        INSERT INTO photo (listing_id, file_path)
+        SELECT 100 + i, '/static/photos/file' || i || '.jpg' FROM generate_series(0, 49999) i;
+
+        INSERT INTO account_favorites (account_email, favorites_email)
+        SELECT 'user' || (i % 5000 + 1) || '@example.com', 'user' || (i * 7 % 5000 + 1) || '@example.com'
+        FROM generate_series(1, 20000) i;
+
+        INSERT INTO message (id, body, recipient, author, parent)
+        SELECT i, 'Are these organic?', 100 + i % 5000, 100 + i * 3 % 5000, i FROM generate_series(1, 50000) i;
+
+        INSERT INTO notification (account_email, seller_email, listing_id, read)
+        SELECT 'user' || (i % 5000 + 1) || '@example.com', 'user' || (i * 7 % 5000 + 1) || '@example.com', 100 + i,
+               i > 5000
+        FROM generate_series(1, 20000) i;
+
+        INSERT INTO notification_count (account_email, unread)
+        SELECT 'user' || i || '@example.com', 1 FROM generate_series(1, 5000) i;
+
+        REFRESH MATERIALIZED VIEW feed_snapshot;
+
+        ANALYZE;
+    '''
+
+    def setUp(self):
+        super(QueryPlanTestCase, self).setUp()
+        db.open_db_connection()
+        with app.open_resource('DB/create-db.sql', mode='r') as f:
+            g.cursor.execute(f.read())
+        g.connection.commit()
+        migrate.migrate(g.connection)
+        g.cursor.execute(self.SYNTHETIC_DATA)
+        g.connection.commit()
+        db.profile_cache.clear()
+
+        self.cursor = ExplainingCursor(g.cursor)
+        g.cursor = self.cursor
+
+    def tearDown(self):
+        g.cursor = self.cursor.cursor
+        db.close_db_connection()
+        super(QueryPlanTestCase, self).tearDown()
+
+    def run_hot_queries(self):
+        db.all_accounts()
+        db.all_listings()
+        db.active_listing_name_counts()
+        db.find_account('user1@example.com')
+        db.find_password('user1@example.com')
+        db.get_id_from_email('user1@example.com')
+        db.find_listing(100)
+        db.get_email_from_listing(100)
+        db.get_first_photo_path(100)
+        db.listings_by_account('user1@example.com')
+        db.fetch_feed(100, 'user1@example.com')
+        db.fetch_feed_snapshot(100, 'user1@example.com', 30)
+        db.list_favorites('user1@example.com')
+        db.fetch_messages(100, 103)
+        db.check_expire_all()
+        db.check_expire_listing(100)
+        db.create_account('new@example.com', 'First', 'Last', 'password')
+        db.update_account('new@example.com', 'First', 'Last', 'A basic biography', 'password')
+        db.update_account('new@example.com', 'First', 'Last', 'A basic biography', '')
+        db.create_listing('Tomatoes', 5, 'Synthetic listing', 5, 'user1@example.com', 'lb')
+        db.update_listing(100, 'Tomatoes', 4, 'Synthetic listing', 5, 'lb')
+        db.buy_listing(100, 1)
+        db.find_listings([101, 102])
+        db.checkout('user1@example.com', {101: 1, 102: 1})
+        db.add_listing_photo_path(100, '/static/photos/file0100.jpg')
+        db.set_photo(db.init_listing_photo(100)['id'], '/static/photos/file0100.jpg')
+        db.last_photo_seq()
+        db.mark_favorite('user1@example.com', 'user2@example.com')
+        db.unread_notification_count('user1@example.com')
+        db.list_notifications('user1@example.com', 50)
+        db.mark_notifications_read('user1@example.com')
+        return self.cursor.plans
+
+    # every query in db.py is explained
+    def test_all_queries_explained(self):
+        functions = {name for name, function in inspect.getmembers(db, inspect.isfunction)
+                     if function.__module__ == 'db' and 'g.cursor.execute(' in inspect.getsource(function)}
+        explained = {function for function, _, _ in self.run_hot_queries()}
+        self.assertEqual(functions - explained, set(), 'Add these to run_hot_queries')
+
+    # no sequential scans on hot tables
+    def test_no_seq_scans(self):
+        for function, query, plan in self.run_hot_queries():
+            if function in self.FULL_SCANS:
+                continue
+            for node in plan_nodes(plan):
+                if node['Node Type'] == 'Seq Scan':
+                    self.assertNotIn(node['Relation Name'], self.HOT_TABLES,
+                                     'Sequential scan on {} for: {}'.format(node['Relation Name'], query))
+
+    # cost budget
+    def test_cost_budget(self):
+        for function, query, plan in self.run_hot_queries():
+            budget = self.COST_BUDGETS.get(function, self.COST_BUDGET)
+            self.assertLessEqual(plan['Total Cost'], budget,
+                                 'Estimated cost {} over budget for: {}'.format(plan['Total Cost'], query))
+
+
+class CreateAppTestCase(unittest.TestCase):
+    # create_app
+    def test_create_app(self):
+        test_app = create_app({'TESTING': True, 'MAX_CONCURRENT_REQUESTS': 3})
+        self.assertEqual(test_app.extensions['admission'].max_concurrent, 3)
+
+        resp = test_app.test_client().get('/metrics')
+        self.assertTrue(b'admission_max_concurrent 3' in resp.data)
+
+
+class AsgiTestCase(FlaskTestCase):
+    def setUp(self):
+        super(AsgiTestCase, self).setUp()
+        db.open_db_connection()
+        DatabaseTestCase.execute_sql('DB/create-db.sql')
+        migrate.migrate(g.connection)
+        db.create_account('buyer@example.com', 'First', 'Last', 'password')
+        db.create_account('seller@example.com', 'First', 'Last', 'password')
+        db.create_listing('Potatoes', 5, 'Some form of description', 5, 'seller@example.com', 'grams')
+        db.close_db_connection()
+
+    # connect_kwargs
+    def test_connect_kwargs(self):
+        kwargs = db_async.connect_kwargs("host=localhost dbname=gardeners application_name='my app' "
+                                         "sslmode=require connect_timeout=5")
+        self.assertEqual(kwargs['timeout'], 5.0)
+        self.assertEqual(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(kwargs['dsn']).query)),
+                         {'host': 'localhost', 'dbname': 'gardeners', 'application_name': 'my app',
+                          'sslmode': 'require'})
+
+        kwargs = db_async.connect_kwargs('postgresql://postgres@localhost/gardeners?sslmode=disable')
+        self.assertEqual(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(kwargs['dsn']).query)),
+                         {'user': 'postgres', 'host': 'localhost', 'dbname': 'gardeners', 'sslmode': 'disable'})
+
+    async def render_feed(self):
+        await db_async.open_pool(asgi.flask_app.config['DATA_SOURCE_NAME'], min_size=1, max_size=2)
+        try:
+            client = asgi.quart_app.test_client()
+            async with client.session_transaction() as session:
+                session['_user_id'] = 'buyer@example.com'
+            resp = await client.get('/feed')
+            return await resp.get_data(), resp.headers['Set-Cookie']
+        finally:
+            await db_async.close_pool()
+
+    # render_feed under asgi.py, adding to the cart through the Flask route
+    def test_render_feed(self):
+        data, cookie = asyncio.run(self.render_feed())
+        self.assertTrue(b'Potatoes' in data)
+        token = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', data).group(1).decode()
+
+        client = asgi.flask_app.test_client()
+        client.set_cookie('session', re.match(r'session=([^;]+)', cookie).group(1))
+        client.post('/cart/add', data={'id': 100, 'amount': 2})
+        with client.session_transaction() as session:
+            self.assertNotIn('cart', session)
+        client.post('/cart/add', data={'id': 100, 'amount': 2, 'csrf_token': token})
+        with client.session_transaction() as session:
+            self.assertEqual(session['cart'], {'100': 2})
+
+
+class KeyedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.KeyedCache(ttl=60)
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.loads
+
+    # get
+    def test_get(self):
+        self.assertEqual(self.cache.get('key', self.load), 1)
+        self.assertEqual(self.cache.get('key', self.load), 1)
+        self.assertEqual(self.cache.get('other', self.load), 2)
+
+    # ttl
+    def test_ttl(self):
+        self.cache.ttl = 0
+        self.assertEqual(self.cache.get('key', self.load), 1)
+        self.assertEqual(self.cache.get('key', self.load), 2)
+
+    # invalidate
+    def test_invalidate(self):
+        self.assertEqual(self.cache.get('key', self.load), 1)
+        self.cache.invalidate('key')
+        self.assertEqual(self.cache.get('key', self.load), 2)
+
+    # single flight
+    def test_single_flight(self):
+        def slow_load():
+            time.sleep(0.2)
+            return self.load()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get('key', slow_load)))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(results, [1] * 10)
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = autocomplete.PrefixIndex()
+        self.index.load(['tomato', 'Tomatillo', 'turnip'], [('Turnips', 3), ('tomatoes', 1)])
+
+    # normalize_name
+    def test_normalize_name(self):
+        self.assertEqual(autocomplete.normalize_name('Tomatoes'), 'tomato')
+        self.assertEqual(autocomplete.normalize_name('  tomato '), 'tomato')
+        self.assertEqual(autocomplete.normalize_name('Blueberries'), 'blueberry')
+        self.assertEqual(autocomplete.normalize_name('Asparagus'), 'asparagus')
+
+    # complete
+    def test_complete(self):
+        self.assertEqual(self.index.complete('t'), ['Turnip', 'Tomato', 'Tomatillo'])
+        self.assertEqual(self.index.complete('tomat'), ['Tomato', 'Tomatillo'])
+        self.assertEqual(self.index.complete('x'), [])
+        self.assertEqual(self.index.complete(''), [])
+
+    # complete, partway through a plural
+    def test_complete_plural(self):
+        self.index.load(['tomato'], [('Blueberries', 1), ('Peaches', 1)])
+        self.assertEqual(self.index.complete('tomatoe'), ['Tomato'])
+        self.assertEqual(self.index.complete('tomatoes'), ['Tomato'])
+        self.assertEqual(self.index.complete('peache'), ['Peaches'])
+        self.assertEqual(self.index.complete('blueberri'), ['Blueberries'])
+        self.assertEqual(self.index.complete('blueberrie'), ['Blueberries'])
+        self.assertEqual(self.index.complete('blueberrys'), ['Blueberries'])
+        self.assertEqual(self.index.complete('tomatoesx'), [])
+
+    # canonical
+    def test_canonical(self):
+        self.assertEqual(self.index.canonical('TOMATOES'), 'Tomato')
+        self.assertEqual(self.index.canonical(' Kohl  rabi '), 'Kohl rabi')
+
+    # add
+    def test_add(self):
+        self.assertEqual(self.index.add('tomatoes'), 'Tomato')
+        self.assertEqual(self.index.complete('t', 1), ['Turnip'])
+        self.index.add('Tomato', 2)
+        self.assertEqual(self.index.complete('t', 1), ['Tomato'])
+
+
+class UnavailableBackend(object):
+    errors = (ConnectionError,)
+
+    def take(self, key, rate, burst):
+        raise ConnectionError('Connection refused')
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.admission = ratelimit.Admission(2)
+        self.admission.limit('login', rate=1, burst=2, key='ip', methods=('POST',))
+        self.admission.limit('create_listing', concurrency=1)
+
+    # rate limit
+    def test_rate_limit(self):
+        self.assertIsNone(self.admission.admit('login', 'POST', None, '1.2.3.4'))
+        self.admission.release('login', 'POST')
+        self.assertIsNone(self.admission.admit('login', 'POST', None, '1.2.3.4'))
+        self.admission.release('login', 'POST')
+        self.assertEqual(self.admission.admit('login', 'POST', None, '1.2.3.4'), (429, 1))
+        self.assertIsNone(self.admission.admit('login', 'POST', None, '5.6.7.8'))
+        self.admission.release('login', 'POST')
+        self.assertIsNone(self.admission.admit('login', 'GET', None, '1.2.3.4'))
+        self.admission.release('login', 'GET')
+
+    # concurrency gate
+    def test_concurrency(self):
+        self.assertIsNone(self.admission.admit('create_listing', 'POST', 'a@example.com', '1.2.3.4'))
+        self.assertEqual(self.admission.admit('create_listing', 'POST', 'b@example.com', '1.2.3.4'), (503, 1))
+        self.assertIsNone(self.admission.admit('render_feed', 'GET', None, '1.2.3.4'))
+        self.assertEqual(self.admission.admit('render_feed', 'GET', None, '1.2.3.4'), (503, 1))
+        self.admission.release('create_listing', 'POST')
+        self.admission.release('render_feed', 'GET')
+        self.assertEqual(self.admission.in_flight, 0)
+        self.assertIsNone(self.admission.admit('create_listing', 'POST', 'b@example.com', '1.2.3.4'))
+
+    # memory backend eviction
+    def test_memory_backend_max_keys(self):
+        backend = ratelimit.MemoryBackend(max_keys=2)
+        backend.take('a', 1, 1)
+        backend.take('b', 1, 1)
+        self.assertGreater(backend.take('a', 1, 1), 0)
+        backend.take('c', 1, 1)
+        # 'b' was used least recently, so it was forgotten
+        self.assertEqual(len(backend._buckets), 2)
+        self.assertEqual(backend.take('b', 1, 1), 0)
+        self.assertGreater(backend.take('c', 1, 1), 0)
+
+    # unavailable backend
+    def test_backend_errors(self):
+        admission = ratelimit.Admission(2, UnavailableBackend())
+        admission.limit('login', rate=1, burst=1, key='ip')
+        self.assertIsNone(admission.admit('login', 'POST', None, '1.2.3.4'))
+        admission.release('login', 'POST')
+        self.assertEqual(admission.admit('login', 'POST', None, '1.2.3.4'), (429, 1))
+        self.assertIn('admission_backend_errors_total 2', admission.metrics())
+
+    # metrics
+    def test_metrics(self):
+        self.admission.admit('render_feed', 'GET', None, '1.2.3.4')
+        self.assertIn('admission_requests_total{endpoint="render_feed",outcome="admitted"} 1', self.admission.metrics())
+        self.assertIn('admission_in_flight 1', self.admission.metrics())
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # sampling
+    def test_profile(self):
+        profile = profiler.Profile(threading.get_ident(), interval=0.001)
+        profile.start()
+        busy_wait(0.1)
+        profile.stop()
+
+        self.assertTrue(any(';busy_wait (tests.py:' in stack for stack in profile.stacks))
+        self.assertFalse(any(';stop (profiler.py:' in stack for stack in profile.stacks))
+        for line in profile.collapsed().splitlines():
+            self.assertTrue(line.rsplit(' ', 1)[1].isdigit())
+
+    # retention
+    def test_write(self):
+        profile = profiler.Profile(threading.get_ident())
+        profile.start()
+        profile.stop()
+        for i in range(4):
+            profile.write(self.directory, 'render_feed', {'endpoint': 'render_feed'}, max_files=3)
+        self.assertEqual(len(os.listdir(self.directory)), 6)
+
+    # X-Profile header
+    def test_profile_header(self):
+        test_app = create_app({'TESTING': True, 'PROFILE_TOKEN': 'secret', 'PROFILE_DIR': self.directory})
+        client = test_app.test_client()
+        self.assertEqual(client.get('/metrics', headers={'X-Profile': 'café'}).status_code, 200)
+        self.assertEqual(client.get('/metrics', headers={'X-Profile': 'wrong'}).status_code, 200)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        self.assertEqual(client.get('/metrics', headers={'X-Profile': 'secret'}).status_code, 200)
+        self.assertEqual(sorted(name.rsplit('.', 1)[1] for name in os.listdir(self.directory)), ['folded', 'json'])
+
+
 def login_test_user():
     db.create_account('test@example.com', 'First', 'Last', 'password')
     account = Account('test@example.com')